@@ -0,0 +1,346 @@
+#coding: utf-8
+"""
+Micro-benchmarks for the preprocessing and training hot paths.
+
+Usage:
+    python benchmark.py normalize --input wiki_sample.txt
+    python benchmark.py phonemize --input wiki_sample.txt --espeak
+    python benchmark.py token_ids --input wiki_sample.txt
+    python benchmark.py masking --synthetic
+    python benchmark.py masking --synthetic --encoded /tmp/encoded_corpus
+    python benchmark.py word_head --batch_size 8
+    python benchmark.py export --lengths 32 128 512
+"""
+
+import time
+import argparse
+
+import yaml
+
+config_path = "Configs/config.yml" # you can change it to anything else
+
+def load_config():
+    return yaml.safe_load(open(config_path))
+
+def load_tokenizer():
+    from transformers import TransfoXLTokenizer
+    return TransfoXLTokenizer.from_pretrained(load_config()['dataset_params']['tokenizer'])
+
+def load_phonemizer(args):
+    if args.espeak:
+        import phonemizer
+        return phonemizer.backend.EspeakBackend(language='en-us', preserve_punctuation=True,  with_stress=True)
+    from phonemize import LookupPhonemizer
+    return LookupPhonemizer()
+
+def load_texts(args):
+    # one article per line, or the first articles of the wikipedia dump if no file is given
+    if args.input is not None:
+        with open(args.input, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()][:args.num_docs]
+    from datasets import load_dataset
+    dataset = load_dataset("wikipedia", "20220301.en", split="train[:%d]" % args.num_docs)
+    return dataset['text']
+
+def timeit(fn, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+def bench_normalize(args):
+    from text_normalize import word_tokenize, preprocess_text, normalize_single, normalize_words, conversion_cache
+
+    docs = [word_tokenize(preprocess_text(t)) for t in load_texts(args)]
+    num_tokens = sum(len(words) for words in docs)
+
+    def baseline():
+        # every token through normalize_single, as before the prefilter
+        out = []
+        for words in docs:
+            out.append([normalize_single(w, words[i - 1] if i > 0 else "", words[i + 1] if i + 1 < len(words) else "")
+                        for i, w in enumerate(words)])
+        return out
+
+    def prefiltered():
+        # cold cache on every repeat
+        conversion_cache.clear()
+        return [normalize_words(words) for words in docs]
+
+    max_size = conversion_cache.max_size
+    conversion_cache.max_size = 0
+    t_before, out_before = timeit(baseline, args.repeat)
+    t_after, out_after = timeit(prefiltered, args.repeat)
+    conversion_cache.max_size = args.cache_size if args.cache_size is not None else max_size
+    t_cached, out_cached = timeit(prefiltered, args.repeat)
+    assert out_before == out_after == out_cached, "prefiltered output differs from baseline"
+
+    print('%d documents, %d tokens' % (len(docs), num_tokens))
+    print('normalize_single on every token: %.0f tokens/s' % (num_tokens / t_before))
+    print('prefiltered dispatch:            %.0f tokens/s (%.2fx)' % (num_tokens / t_after, t_before / t_after))
+    print('memoized converters:             %.0f tokens/s (%.2fx)' % (num_tokens / t_cached, t_before / t_cached))
+    stats = conversion_cache.stats()
+    print('cache: %d / %d entries' % (stats['size'], stats['max_size']))
+    for label, converter in stats['converters'].items():
+        print('  %-10s %8d lookups, hit rate %.3f' % (label, converter['hits'] + converter['misses'], converter['hit_rate']))
+
+def bench_phonemize(args):
+    import string
+    from text_normalize import normalize_text, remove_accents
+    from phonemize import phonemize_words
+
+    tokenizer = load_tokenizer()
+    global_phonemizer = load_phonemizer(args)
+    words_list = [tokenizer.tokenize(normalize_text(remove_accents(t))) for t in load_texts(args)]
+    num_words = sum(len(words) for words in words_list)
+
+    def per_word():
+        return [[global_phonemizer.phonemize([word], strip=True)[0] if word not in string.punctuation else word for word in words]
+                for words in words_list]
+
+    def per_document():
+        return [phonemize_words([words], global_phonemizer)[0] for words in words_list]
+
+    def per_batch():
+        return phonemize_words(words_list, global_phonemizer)
+
+    t_word, out_word = timeit(per_word)
+    t_doc, out_doc = timeit(per_document)
+    t_batch, out_batch = timeit(per_batch)
+    assert out_word == out_doc == out_batch, "batched phonemes differ from per-word phonemes"
+
+    print('%d documents, %d words' % (len(words_list), num_words))
+    print('one backend call per word:     %.0f words/s' % (num_words / t_word))
+    print('one backend call per document: %.0f words/s (%.2fx)' % (num_words / t_doc, t_word / t_doc))
+    print('one backend call per batch:    %.0f words/s (%.2fx)' % (num_words / t_batch, t_word / t_batch))
+
+def bench_token_ids(args):
+    from text_normalize import normalize_text, remove_accents
+    from phonemize import get_token_id
+
+    tokenizer = load_tokenizer()
+    words = [w for t in load_texts(args) for w in tokenizer.tokenize(normalize_text(remove_accents(t)))]
+    words = [w.replace('@', '') if '@' in w and len(w) > 1 else w for w in words]
+    token_id = get_token_id(tokenizer)
+
+    t_encode, ids_encode = timeit(lambda: [tokenizer.encode(w)[0] for w in words])
+    t_cached, ids_cached = timeit(lambda: [token_id(w) for w in words])
+    assert ids_encode == ids_cached, "memoized ids differ from tokenizer.encode"
+
+    print('%d words, %d unique' % (len(words), len(set(words))))
+    print('tokenizer.encode per word: %.0f words/s' % (len(words) / t_encode))
+    print('memoized lookup:           %.0f words/s (%.2fx)' % (len(words) / t_cached, t_encode / t_cached))
+    print(token_id.cache_info())
+
+def synthetic_samples(num_samples, num_words=300, vocab_size=1000, seed=0):
+    # random phoneme words with wikipedia-like lengths, for benchmarks without the processed dataset
+    import numpy as np
+    from text_utils import _letters_ipa
+    rng = np.random.default_rng(seed)
+    symbols = list(_letters_ipa)
+    samples = []
+    for _ in range(num_samples):
+        n = rng.integers(num_words // 2, num_words * 2)
+        samples.append({'phonemes': [''.join(rng.choice(symbols, rng.integers(1, 10))) for _ in range(n)],
+                        'input_ids': rng.integers(0, vocab_size, n).tolist()})
+    return samples
+
+def load_samples(args):
+    config = load_config()
+    if args.synthetic:
+        import pickle
+        import tempfile
+        samples = synthetic_samples(args.num_samples)
+        token_maps = {i: {'word': str(i), 'token': i} for i in range(1000)}
+        token_maps[config['dataset_params']['word_separator']] = {'word': '<formula>', 'token': 1000}
+        with tempfile.NamedTemporaryFile(suffix='.pkl', delete=False) as f:
+            pickle.dump(token_maps, f)
+        return samples, dict(config['dataset_params'], token_maps=f.name)
+    from preprocess import load_processed
+    dataset = load_processed(config['data_folder'])
+    return dataset.select(range(args.num_samples)), config['dataset_params']
+
+def bench_masking(args):
+    from dataloader import FilePathDataset, EncodedPhonemeDataset
+
+    samples, dataset_config = load_samples(args)
+    if args.encoded is not None:
+        # encode the same samples first so both formats are timed on identical data
+        from phoneme_corpus import encode_corpus
+        from token_maps import load_token_maps
+        token_maps = load_token_maps(dataset_config['token_maps'])
+        encode_corpus(samples, args.encoded, token_maps, word_separator=dataset_config['word_separator'])
+        dataset = EncodedPhonemeDataset(args.encoded, **dataset_config)
+    else:
+        dataset = FilePathDataset(samples, **dataset_config)
+
+    num_tokens = 0
+    start = time.perf_counter()
+    for i in range(len(dataset)):
+        num_tokens += len(dataset[i][0])
+    elapsed = time.perf_counter() - start
+
+    print('%d samples, %d phoneme positions' % (len(dataset), num_tokens))
+    print('%s.__getitem__: %.1f samples/s, %.0f positions/s' % (type(dataset).__name__, len(dataset) / elapsed, num_tokens / elapsed))
+
+def word_head_step(mode, args, queue):
+    # runs in a fresh process so that ru_maxrss is the peak of this mode only
+    import resource
+    import torch
+    from transformers import AlbertConfig, AlbertModel
+    from model import MultiTaskModel, MultiTaskLoss
+
+    torch.manual_seed(0)
+    config = load_config()
+    model_params = dict(config['model_params'], num_hidden_layers=args.num_layers)
+    bert = MultiTaskModel(AlbertModel(AlbertConfig(**model_params)),
+                          num_vocab=args.num_vocab,
+                          num_tokens=model_params['vocab_size'],
+                          hidden_size=model_params['hidden_size'],
+                          vocab_loss='full' if mode == 'all_positions' else mode)
+    criterion = MultiTaskLoss()
+
+    batch_size, length = args.batch_size, args.length
+    lengths = torch.randint(length // 4, length + 1, (batch_size,))
+    lengths[0] = length
+    phonemes = torch.randint(0, model_params['vocab_size'], (batch_size, length))
+    words = torch.randint(0, args.num_vocab, (batch_size, length))
+    labels = torch.randint(0, model_params['vocab_size'], (batch_size, length))
+    masked = torch.rand(batch_size, length) < 0.15
+    attention_mask = (torch.arange(length)[None, :] < lengths[:, None]).int()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        if mode == 'all_positions':
+            tokens_pred, words_pred = bert(phonemes, attention_mask=attention_mask)
+            loss_vocab, loss_token = criterion(tokens_pred, words_pred, labels, words, lengths, masked)
+        else:
+            word_mask = criterion.word_mask(lengths, length)
+            tokens_pred, words_pred = bert(phonemes, attention_mask=attention_mask, word_mask=word_mask, word_targets=words[word_mask])
+            loss_vocab, loss_token = criterion(tokens_pred, words_pred, labels, words, lengths, masked, word_mask=word_mask)
+        (loss_vocab + loss_token).backward()
+        bert.zero_grad(set_to_none=True)
+        times.append(time.perf_counter() - start)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((min(times), (rss_after - rss_before) / 1024, rss_after / 1024))
+
+def bench_word_head(args):
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    print('batch %dx%d, %d words, %d layers' % (args.batch_size, args.length, args.num_vocab, args.num_layers))
+    for mode in ['all_positions', 'full', 'chunked', 'sampled']:
+        queue = ctx.Queue()
+        process = ctx.Process(target=word_head_step, args=(mode, args, queue))
+        process.start()
+        step_time, peak_increase, peak = queue.get()
+        process.join()
+        print('%-14s step %.2fs, peak RSS +%.0f MB during the step (%.0f MB total)' % (mode, step_time, peak_increase, peak))
+
+def export_variant(variant, args, queue):
+    # runs in a fresh process so that ru_maxrss only counts this variant
+    import os
+    import resource
+    import tempfile
+    import torch
+    from transformers import AlbertConfig, AlbertModel
+    from export import HiddenStates, quantize, export_torchscript, export_onnx, OnnxEncoder
+
+    torch.manual_seed(0)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.checkpoint is not None:
+        from inference import PLBertEncoder
+        bert = PLBertEncoder.from_checkpoint(args.checkpoint, config_path).bert
+    else:
+        bert = AlbertModel(AlbertConfig(**load_config()['model_params'])).eval()
+
+    path = os.path.join(tempfile.mkdtemp(), 'encoder')
+    if variant == 'fp32':
+        model = HiddenStates(bert).eval()
+    elif variant == 'int8':
+        model = HiddenStates(quantize(bert)).eval()
+    elif variant == 'torchscript':
+        model = export_torchscript(bert, path)
+    elif variant == 'torchscript_int8':
+        model = export_torchscript(quantize(bert), path)
+    else:
+        export_onnx(bert, path)
+        model = OnnxEncoder(path, num_threads=args.num_threads)
+    del bert
+
+    results = []
+    for length in args.lengths:
+        phonemes = torch.randint(1, 178, (args.batch_size, length))
+        attention_mask = torch.ones((args.batch_size, length), dtype=torch.long)
+        with torch.inference_mode():
+            model(phonemes, attention_mask) # warm up
+            elapsed, _ = timeit(lambda: model(phonemes, attention_mask), args.repeat)
+        results.append((length, args.batch_size / elapsed))
+    queue.put((results, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def bench_export(args):
+    import importlib.util
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    variants = ['fp32', 'int8', 'torchscript', 'torchscript_int8']
+    if importlib.util.find_spec('onnxruntime') is not None and importlib.util.find_spec('onnx') is not None:
+        variants.append('onnx')
+    print('batch %d, %s threads' % (args.batch_size, args.num_threads or 'default'))
+    for variant in variants:
+        queue = ctx.Queue()
+        process = ctx.Process(target=export_variant, args=(variant, args, queue))
+        process.start()
+        results, peak = queue.get()
+        process.join()
+        print('%-17s %s, peak RSS %.0f MB' % (variant, ', '.join('%d: %.1f sentences/s' % r for r in results), peak))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('normalize', help='tokens/s of text normalization with and without the prefilter and the converter cache')
+    p.add_argument('--input', default=None, help='text file with one article per line')
+    p.add_argument('--num_docs', type=int, default=1000)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--cache_size', type=int, default=None, help='entries of the converter cache, defaults to text_normalize.conversion_cache')
+    p.set_defaults(func=bench_normalize)
+
+    p = subparsers.add_parser('phonemize', help='words/s of per-word vs batched phonemizer calls')
+    p.add_argument('--input', default=None, help='text file with one article per line')
+    p.add_argument('--num_docs', type=int, default=100)
+    p.add_argument('--espeak', action='store_true', help='use the espeak backend instead of the lookup stand-in')
+    p.set_defaults(func=bench_phonemize)
+
+    p = subparsers.add_parser('token_ids', help='words/s of tokenizer.encode vs the memoized word -> id lookup')
+    p.add_argument('--input', default=None, help='text file with one article per line')
+    p.add_argument('--num_docs', type=int, default=1000)
+    p.set_defaults(func=bench_token_ids)
+
+    p = subparsers.add_parser('masking', help='samples/s of FilePathDataset.__getitem__')
+    p.add_argument('--synthetic', action='store_true', help='use random samples instead of the processed dataset')
+    p.add_argument('--num_samples', type=int, default=2000)
+    p.add_argument('--encoded', default=None, help='encode the samples to this directory and time EncodedPhonemeDataset')
+    p.set_defaults(func=bench_masking)
+
+    p = subparsers.add_parser('word_head', help='CPU step time and peak memory of the word prediction head modes')
+    p.add_argument('--batch_size', type=int, default=8)
+    p.add_argument('--length', type=int, default=512)
+    p.add_argument('--num_vocab', type=int, default=84827)
+    p.add_argument('--num_layers', type=int, default=1, help='encoder layers, few so that the head dominates')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_word_head)
+
+    p = subparsers.add_parser('export', help='CPU sentences/s and peak memory of the fp32, int8 and exported encoders')
+    p.add_argument('--checkpoint', default=None, help='training checkpoint, random weights if not given')
+    p.add_argument('--lengths', type=int, nargs='+', default=[32, 128, 512])
+    p.add_argument('--batch_size', type=int, default=8)
+    p.add_argument('--num_threads', type=int, default=None)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_export)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,228 @@
+#coding: utf-8
+"""
+Checkpoint saving and discovery for the training loop.
+
+`AsyncCheckpointWriter.save` copies the state to CPU memory and returns, the copy is
+serialized by a background thread to a temporary file that is renamed into place once
+complete, so a crash never leaves a truncated `step_*.t7` behind.
+
+Every written checkpoint is recorded in `checkpoints.json` of the log directory
+(step -> file name, size, sha256), so resuming reads one small file instead of
+listing the directory.
+
+Usage:
+    writer = AsyncCheckpointWriter(log_dir, keep_last=5)
+    blocked = writer.save(state, osp.join(log_dir, 'step_%d.t7' % step))
+    writer.close()
+
+    step = resume(log_dir, model, optimizer) # 0 if there is no checkpoint yet
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import os.path as osp
+from collections import OrderedDict
+
+import torch
+
+def to_cpu(obj):
+    """
+    Copies every tensor of a (nested) state dict to CPU memory, so that training can keep
+    updating the originals while the copy is written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    sha256 of a checkpoint file, recorded in the manifest and keying the cached encoder outputs.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def checkpoint_step(path):
+    match = re.search(r'step_(\d+)\.t7$', path)
+    return int(match.group(1)) if match is not None else None
+
+class CheckpointIndex(object):
+    """
+    Manifest of the checkpoints of `log_dir`. A directory without a manifest (written before
+    it existed) is listed once, the manifest is then written on the next `add` or `remove`.
+    """
+
+    manifest_name = 'checkpoints.json'
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.path = osp.join(log_dir, self.manifest_name)
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if osp.exists(self.path):
+            with open(self.path) as f:
+                entries = json.load(f)['checkpoints']
+            return {int(step): entry for step, entry in entries.items()}
+
+        entries = {}
+        if osp.isdir(self.log_dir):
+            for name in os.listdir(self.log_dir):
+                step = checkpoint_step(name)
+                if step is not None:
+                    entries[step] = {'name': name, 'size': osp.getsize(osp.join(self.log_dir, name)), 'sha256': None}
+        return entries
+
+    def save(self):
+        manifest = {'checkpoints': OrderedDict((str(step), self.entries[step]) for step in sorted(self.entries))}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def add(self, path, step=None):
+        """
+        Records the checkpoint at `path`, which must be inside `log_dir`.
+        """
+        step = checkpoint_step(path) if step is None else step
+        entry = {'name': osp.basename(path), 'size': osp.getsize(path), 'sha256': file_hash(path)}
+        with self.lock:
+            self.entries[step] = entry
+            self.save()
+
+    def remove(self, step):
+        """
+        Deletes the checkpoint of `step` and its entry.
+        """
+        with self.lock:
+            entry = self.entries.pop(step)
+            self.save()
+        path = osp.join(self.log_dir, entry['name'])
+        if osp.exists(path):
+            os.remove(path)
+
+    def steps(self):
+        return sorted(self.entries)
+
+    def path_of(self, step):
+        return osp.join(self.log_dir, self.entries[step]['name'])
+
+    def latest(self, verify=False):
+        """
+        (step, path) of the newest checkpoint whose file still has the recorded size (and
+        sha256 if `verify`), None if there is none.
+        """
+        for step in reversed(self.steps()):
+            entry = self.entries[step]
+            path = self.path_of(step)
+            if not osp.exists(path) or osp.getsize(path) != entry['size']:
+                continue
+            if verify and entry['sha256'] is not None and file_hash(path) != entry['sha256']:
+                continue
+            return step, path
+        return None
+
+def load_checkpoint(path, model, optimizer=None, sampler=None, strict=False):
+    """
+    Loads a `step_*.t7` checkpoint into an unwrapped MultiTaskModel, and into `optimizer`
+    and the data order of `sampler` (a BucketBatchSampler) if given (full-state resume).
+    Returns the checkpoint.
+    """
+    # mmap so that a model-only resume never reads the optimizer state
+    checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    state_dict = OrderedDict()
+    for k, v in checkpoint['net'].items():
+        if k.startswith('module.'):
+            k = k[7:] # remove `module.`
+        state_dict[k] = v
+    model.load_state_dict(state_dict, strict=strict)
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    # checkpoints written before the sampler state was saved start a new data order
+    if sampler is not None and 'sampler' in checkpoint:
+        sampler.load_state_dict(checkpoint['sampler'])
+    return checkpoint
+
+def resume(log_dir, model, optimizer=None, sampler=None, verify=False):
+    """
+    Loads the newest checkpoint of `log_dir` (see `load_checkpoint`), returns its step or 0
+    if there is none.
+    """
+    latest = CheckpointIndex(log_dir).latest(verify=verify)
+    if latest is None:
+        return 0
+    step, path = latest
+    load_checkpoint(path, model, optimizer, sampler)
+    return step
+
+class AsyncCheckpointWriter(object):
+    """
+    Args:
+      log_dir (str): directory of the `step_*.t7` checkpoints, recorded in its CheckpointIndex.
+      keep_last (int): if set (at least 1), only the newest `keep_last` checkpoints of `log_dir` are kept.
+
+    At most one write is in flight: a save waits for the previous one to finish, which bounds
+    the memory of the CPU snapshots to one checkpoint.
+    """
+
+    def __init__(self, log_dir, keep_last=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1 (the checkpoint to resume from), got %d' % keep_last)
+        self.log_dir = log_dir
+        self.keep_last = keep_last
+        self.index = CheckpointIndex(log_dir)
+        self._thread = None
+        self._error = None
+
+    def save(self, state, path):
+        """
+        Snapshots `state` and starts writing it to `path`. Returns the seconds the caller was
+        blocked (waiting for the previous write plus the copy to CPU).
+        """
+        start = time.perf_counter()
+        self.wait()
+        snapshot = to_cpu(state)
+        self._thread = threading.Thread(target=self._write, args=(snapshot, path))
+        self._thread.start()
+        return time.perf_counter() - start
+
+    def _write(self, state, path):
+        try:
+            tmp_path = path + '.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+            self.index.add(path)
+            self.prune()
+        except Exception as e:
+            self._error = e
+
+    def prune(self):
+        if self.keep_last is None:
+            return
+        for step in self.index.steps()[:-self.keep_last]:
+            self.index.remove(step)
+
+    def wait(self):
+        """
+        Blocks until the pending write is on disk, re-raising its error if it failed.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
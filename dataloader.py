@@ -1,14 +1,16 @@
 #coding: utf-8
 
 import os
+import json
+import hashlib
 import os.path as osp
 import time
+import bisect
 import random
 import numpy as np
 import random
 
 import string
-import pickle
 
 import torch
 from torch import nn
@@ -16,14 +18,13 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 from text_utils import TextCleaner
+from phoneme_corpus import PhonemeCorpus
+from token_maps import load_token_maps, lookup as lookup_tokens
 
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-np.random.seed(1)
-random.seed(1)
-
 class FilePathDataset(torch.utils.data.Dataset):
     def __init__(self, dataset,
                  token_maps="token_maps.pkl",
@@ -47,74 +48,139 @@ class FilePathDataset(torch.utils.data.Dataset):
         self.token_separator = token_separator
         self.token_mask = token_mask
         
-        with open(token_maps, 'rb') as handle:
-            self.token_maps = pickle.load(handle)     
+        self.mask_index = self.text_cleaner(token_mask)[0]
+        self.separator_index = self.text_cleaner(token_separator)[0]
+        self.label_separator_index = self.text_cleaner(" ")[0]
+        
+        self.token_maps = self.load_token_maps(token_maps)
+    
+    def load_token_maps(self, token_maps):
+        # dense tokenizer id -> token-map id array, memory-mapped when saved as .npy
+        return load_token_maps(token_maps)
             
     def __len__(self):
         return len(self.data)
+    
+    def sample_lengths(self):
+        """
+        Phoneme length of every sample before cropping (each word plus its separator).
+        """
+        return np.array([sum(len(p) + 1 for p in sample['phonemes']) for sample in self.data], dtype=np.int64)
+
+    def fingerprint(self):
+        """
+        Identifies the rows and their order for the lengths cache, None if unknown.
+        """
+        return getattr(self.data, '_fingerprint', None)
 
     def __getitem__(self, idx):
 
         phonemes = self.data[idx]['phonemes']
         input_ids = self.data[idx]['input_ids']
-
-        words = []
-        labels = ""
-        phoneme = ""
-
-        phoneme_list = ''.join(phonemes)
-        masked_index = []
-        for z in zip(phonemes, input_ids):
-            z = list(z)
-            
-            words.extend([z[1]] * len(z[0]))
-            words.append(self.word_separator)
-            labels += z[0] + " "
-
-            if np.random.rand() < self.word_mask_prob:
-                if np.random.rand() < self.replace_prob:
-                    if np.random.rand() < (self.phoneme_mask_prob / self.replace_prob): 
-                        phoneme += ''.join([phoneme_list[np.random.randint(0, len(phoneme_list))] for _ in range(len(z[0]))])  # randomized
-                    else:
-                        phoneme += z[0]
-                else:
-                    phoneme += self.token_mask * len(z[0]) # masked
-                    
-                masked_index.extend((np.arange(len(phoneme) - len(z[0]), len(phoneme))).tolist())
-            else:
-                phoneme += z[0] 
-
-            phoneme += self.token_separator
-
-
+        
+        phoneme, words, labels, masked_index = self.mask(phonemes, input_ids)
+        
+        return torch.from_numpy(phoneme), torch.from_numpy(words), torch.from_numpy(labels), masked_index
+    
+    def mask(self, phonemes, input_ids):
+        symbols = np.array(self.text_cleaner(''.join(phonemes)), dtype=np.int64)
+        lengths = np.array([len(p) for p in phonemes], dtype=np.int64)
+        token_ids = lookup_tokens(self.token_maps, input_ids)
+        
+        return self.mask_ids(symbols, lengths, token_ids, self.token_maps[self.word_separator])
+    
+    def mask_ids(self, symbols, lengths, token_ids, separator_token):
+        """
+        Masks one sample at once on int64 arrays.
+        
+        Args:
+          symbols: TextCleaner ids of all phonemes of the sample, without separators.
+          lengths: number of phoneme symbols of each word.
+          token_ids: token-map id of each word.
+          separator_token: token-map id of the word separator.
+        
+        Every word is followed by a separator position. Word-level decisions are drawn together
+        and expanded to phoneme positions with np.repeat:
+          - word_mask_prob: the word is selected for prediction
+          - of those, 1 - replace_prob: all its phonemes become token_mask
+          - of those, phoneme_mask_prob: its phonemes are replaced by random phonemes of the sample
+          - the rest keep their phonemes
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        num_words = len(lengths)
+        
+        word_index = np.repeat(np.arange(num_words), lengths + 1)
+        is_separator = np.zeros(len(word_index), dtype=bool)
+        is_separator[np.cumsum(lengths + 1) - 1] = True
+        
+        # labels are the unmasked phonemes, each word followed by a space
+        labels = np.empty(len(word_index), dtype=np.int64)
+        labels[~is_separator] = symbols
+        labels[is_separator] = self.label_separator_index
+        
+        word_index[is_separator] = num_words
+        words = np.append(token_ids, separator_token).astype(np.int64)[word_index]
+        
+        draws = np.random.rand(num_words, 3)
+        masked = draws[:, 0] < self.word_mask_prob
+        replaced = masked & (draws[:, 1] < self.replace_prob)
+        randomized = replaced & (draws[:, 2] < (self.phoneme_mask_prob / self.replace_prob))
+        
+        masked = np.append(masked, False)[word_index]
+        masked_tokens = masked & ~np.append(replaced, False)[word_index]
+        randomized = np.append(randomized, False)[word_index]
+        
+        phoneme = labels.copy()
+        phoneme[is_separator] = self.separator_index
+        phoneme[masked_tokens] = self.mask_index
+        if randomized.any():
+            phoneme[randomized] = symbols[np.random.randint(0, len(symbols), size=randomized.sum())]
+        
+        masked_index = np.nonzero(masked)[0]
+        
         mel_length = len(phoneme)
-        masked_idx = np.array(masked_index)
-        masked_index = []
         if mel_length > self.max_mel_length:
             random_start = np.random.randint(0, mel_length - self.max_mel_length)
-            phoneme = phoneme[random_start:random_start + self.max_mel_length]
-            words = words[random_start:random_start + self.max_mel_length]
-            labels = labels[random_start:random_start + self.max_mel_length]
-            
-            for m in masked_idx:
-                if m >= random_start and m < random_start + self.max_mel_length:
-                    masked_index.append(m - random_start)
-        else:
-            masked_index = masked_idx
-            
-        phoneme = self.text_cleaner(phoneme)
-        labels = self.text_cleaner(labels)
-        words = [self.token_maps[w]['token'] for w in words]
+            end = random_start + self.max_mel_length
+            phoneme = phoneme[random_start:end]
+            words = words[random_start:end]
+            labels = labels[random_start:end]
+            masked_index = masked_index[(masked_index >= random_start) & (masked_index < end)] - random_start
         
         assert len(phoneme) == len(words)
         assert len(phoneme) == len(labels)
         
-        phonemes = torch.LongTensor(phoneme)
-        labels = torch.LongTensor(labels)
-        words = torch.LongTensor(words)
+        return phoneme, words, labels, masked_index
+        
+class EncodedPhonemeDataset(FilePathDataset):
+    """
+    Reads a corpus written by phoneme_corpus.encode_corpus and masks the stored integer
+    arrays directly, without TextCleaner or token_maps at train time.
+    """
+    def __init__(self, path, **kwargs):
+        self.corpus = PhonemeCorpus(path)
+        super().__init__(self.corpus, **kwargs)
+    
+    def load_token_maps(self, token_maps):
+        # token-map ids are already stored in the corpus
+        return None
+    
+    def sample_lengths(self):
+        arrays = self.corpus.arrays
+        article_offsets = np.asarray(arrays['article_offsets'])
+        num_symbols = np.diff(np.asarray(arrays['word_offsets'])[article_offsets])
+        return num_symbols + np.diff(article_offsets)
+
+    def fingerprint(self):
+        return hashlib.sha256(json.dumps(self.corpus.meta, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    
+    def __getitem__(self, idx):
+        symbols, lengths, token_ids = self.corpus[idx]
         
-        return phonemes, words, labels, masked_index
+        phoneme, words, labels, masked_index = self.mask_ids(symbols, lengths, token_ids, self.corpus.separator_token)
         
+        return torch.from_numpy(phoneme), torch.from_numpy(words), torch.from_numpy(labels), masked_index
+    
 class Collater(object):
     """
     Args:
@@ -140,36 +206,361 @@ class Collater(object):
         words = torch.zeros((batch_size, max_text_length)).long()
         labels = torch.zeros((batch_size, max_text_length)).long()
         phonemes = torch.zeros((batch_size, max_text_length)).long()
+        # True at the positions whose phonemes are predicted
+        masked = torch.zeros((batch_size, max_text_length), dtype=torch.bool)
         input_lengths = []
-        masked_indices = []
         for bid, (phoneme, word, label, masked_index) in enumerate(batch):
             
             text_size = phoneme.size(0)
             words[bid, :text_size] = word
             labels[bid, :text_size] = label
             phonemes[bid, :text_size] = phoneme
+            masked[bid, torch.as_tensor(masked_index, dtype=torch.long)] = True
             input_lengths.append(text_size)
-            masked_indices.append(masked_index)
 
-        return words, labels, phonemes, input_lengths, masked_indices
+        return words, labels, phonemes, input_lengths, masked
+
+class PackingCollater(object):
+    """
+    Collates rows of PackedDataset. Besides the outputs of Collater, returns per-segment
+    `position_ids` and the (batch, length) `segment_ids` of every position (0 is padding),
+    from which MultiTaskModel builds the block-diagonal attention mask on the device.
+    """
+
+    def __call__(self, batch):
+        batch_size = len(batch)
+        input_lengths = [sum(b[0].size(0) for b in pack) for pack in batch]
+        max_text_length = max(input_lengths)
+
+        words = torch.zeros((batch_size, max_text_length)).long()
+        labels = torch.zeros((batch_size, max_text_length)).long()
+        phonemes = torch.zeros((batch_size, max_text_length)).long()
+        position_ids = torch.zeros((batch_size, max_text_length)).long()
+        # 0 is padding, segments are numbered from 1
+        segment_ids = torch.zeros((batch_size, max_text_length)).long()
+        masked = torch.zeros((batch_size, max_text_length), dtype=torch.bool)
+        for bid, pack in enumerate(batch):
+            offset = 0
+            for sid, (phoneme, word, label, masked_index) in enumerate(pack):
+                text_size = phoneme.size(0)
+                words[bid, offset:offset + text_size] = word
+                labels[bid, offset:offset + text_size] = label
+                phonemes[bid, offset:offset + text_size] = phoneme
+                position_ids[bid, offset:offset + text_size] = torch.arange(text_size)
+                segment_ids[bid, offset:offset + text_size] = sid + 1
+                masked[bid, offset + torch.as_tensor(masked_index, dtype=torch.long)] = True
+                offset += text_size
+
+        return words, labels, phonemes, input_lengths, masked, position_ids, segment_ids
 
 
+def pack_lengths(lengths, max_length=512):
+    """
+    Best-fit decreasing bin packing of sample lengths into rows of `max_length`.
+    Returns a list of packs, each a list of sample indices.
+    """
+    lengths = np.minimum(np.asarray(lengths), max_length)
+    packs = []
+    # remaining capacity -> packs with that much room left, `capacities` is kept sorted
+    open_packs = {}
+    capacities = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        length = int(lengths[i])
+        j = bisect.bisect_left(capacities, length)
+        if j < len(capacities):
+            capacity = capacities[j]
+            pack = open_packs[capacity].pop()
+            if len(open_packs[capacity]) == 0:
+                del open_packs[capacity]
+                capacities.pop(j)
+        else:
+            capacity = max_length
+            pack = len(packs)
+            packs.append([])
+        packs[pack].append(i)
+        
+        capacity -= length
+        if capacity > 0:
+            if capacity not in open_packs:
+                open_packs[capacity] = []
+                bisect.insort(capacities, capacity)
+            open_packs[capacity].append(pack)
+    return packs
+
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    Packs several (masked) samples of `dataset` into one row of at most `max_mel_length` phonemes.
+    Every item is the list of samples of one row, see PackingCollater.
+    """
+    def __init__(self, dataset, lengths):
+        self.dataset = dataset
+        self.max_length = dataset.max_mel_length
+        self.packs = pack_lengths(lengths, self.max_length)
+        
+        capped = np.minimum(np.asarray(lengths), self.max_length)
+        self.efficiency = capped.sum() / max(len(self.packs) * self.max_length, 1)
+        logger.info('Packed %d samples into %d rows, %.1f%% of the positions are real tokens' % 
+                    (len(capped), len(self.packs), 100 * self.efficiency))
+    
+    def __len__(self):
+        return len(self.packs)
+    
+    def __getitem__(self, idx):
+        return [self.dataset[i] for i in self.packs[idx]]
+
+def load_lengths(dataset, cache_path=None):
+    """
+    Sample lengths of `dataset`, computed once and cached to `cache_path` (.npy). The fingerprint
+    of the dataset is stored next to it (.json), a cache of other rows is recomputed.
+    """
+    fingerprint = dataset.fingerprint() if hasattr(dataset, 'fingerprint') else None
+    meta_path = osp.splitext(cache_path)[0] + '.json' if cache_path is not None else None
+    if cache_path is not None and osp.exists(cache_path):
+        lengths = np.load(cache_path)
+        cached = None
+        if osp.exists(meta_path):
+            with open(meta_path) as f:
+                cached = json.load(f).get('fingerprint')
+        if len(lengths) != len(dataset):
+            logger.warning('%s has %d lengths but the dataset has %d samples, recomputing' % (cache_path, len(lengths), len(dataset)))
+        elif fingerprint is not None and cached != fingerprint:
+            logger.warning('%s was computed for dataset %s, not %s, recomputing' % (cache_path, cached, fingerprint))
+        else:
+            return lengths
+    
+    lengths = dataset.sample_lengths()
+    if cache_path is not None:
+        np.save(cache_path, lengths)
+        with open(meta_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'num_samples': len(lengths)}, f)
+    return lengths
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches samples of similar length to reduce padding.
+    
+    Indices are shuffled, cut into pools of `bucket_size` batches, sorted by length inside
+    each pool and batched; the batches are then shuffled again.
+    
+    Args:
+      lengths: sample lengths, capped at `max_length` (the crop of FilePathDataset).
+      batch_size (int): fixed number of samples per batch, ignored if `max_tokens` is given.
+      max_tokens (int): fill each batch up to this many padded tokens (longest sample * batch size).
+      num_replicas (int), rank (int): every process builds the same global batches and keeps the
+        `rank`-th strided share, so the global batch is split across processes like
+        Accelerate's `split_batches=True`. Do not pass the loader to `accelerator.prepare` then.
+    """
+    def __init__(self, lengths,
+                 batch_size=None,
+                 max_tokens=None,
+                 max_length=512,
+                 bucket_size=100,
+                 shuffle=True,
+                 drop_last=True,
+                 num_replicas=1,
+                 rank=0,
+                 seed=0):
+        
+        if batch_size is None and max_tokens is None:
+            raise ValueError('either batch_size or max_tokens is required')
+        if max_tokens is not None and max_tokens < max_length:
+            raise ValueError('max_tokens %d is smaller than max_length %d' % (max_tokens, max_length))
+        if max_tokens is None and batch_size % num_replicas != 0:
+            raise ValueError('batch_size %d is not divisible by %d processes' % (batch_size, num_replicas))
+        
+        self.lengths = np.minimum(np.asarray(lengths), max_length)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0 # first batch of the next pass
+        self._batches = None
+        self._pass = None
+        
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.position = 0
+        self._batches = None
+    
+    def state_dict(self, num_consumed=None):
+        """
+        Epoch and position to continue from with `load_state_dict`.
+        
+        DataLoader workers and Accelerate prefetch batches, so the sampler runs ahead of the
+        training loop: pass the number of batches the loop has consumed in the current pass
+        for an exact position, otherwise every batch yielded so far counts as consumed.
+        """
+        if self._pass is None:
+            return {'epoch': self.epoch, 'position': self.position, 'seed': self.seed}
+        epoch, start, num_batches, yielded = self._pass
+        position = start + (yielded if num_consumed is None else num_consumed)
+        if position >= num_batches:
+            epoch, position = epoch + 1, 0
+        return {'epoch': epoch, 'position': position, 'seed': self.seed}
+    
+    def load_state_dict(self, state):
+        if state['seed'] != self.seed:
+            logger.warning('resuming the data order of seed %d with seed %d' % (state['seed'], self.seed))
+        self.set_epoch(state['epoch'])
+        self.position = state['position']
+        self._pass = None
+    
+    def split(self, indices):
+        # cut length-sorted indices into batches
+        if self.max_tokens is None:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        
+        batches = []
+        batch = []
+        longest = 0
+        for i in indices:
+            longest_with = max(longest, self.lengths[i])
+            if len(batch) > 0 and longest_with * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                longest_with = self.lengths[i]
+            batch.append(i)
+            longest = longest_with
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+    
+    def batches(self):
+        if self._batches is not None:
+            return self._batches
+        
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        
+        if self.max_tokens is not None:
+            # about `bucket_size` batches of `max_tokens`, whatever batch_size is
+            mean_length = float(self.lengths.mean()) if len(self.lengths) > 0 else 1.0
+            pool_size = self.bucket_size * max(1, int(self.max_tokens // max(mean_length, 1)))
+        else:
+            pool_size = self.bucket_size * self.batch_size
+        batches = []
+        for i in range(0, len(indices), pool_size):
+            pool = indices[i:i + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(self.split(pool.tolist()))
+        
+        # every process must get the same number of samples
+        batches = [b[:len(b) - len(b) % self.num_replicas] for b in batches]
+        if self.drop_last and self.max_tokens is None:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        batches = [b for b in batches if len(b) > 0]
+        
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+    
+    def __iter__(self):
+        batches = self.batches()
+        self._pass = [self.epoch, self.position, len(batches), 0]
+        for batch in batches[self.position:]:
+            self._pass[3] += 1
+            yield batch[self.rank::self.num_replicas]
+        # reshuffle on the next pass even if set_epoch is never called
+        self.set_epoch(self.epoch + 1)
+    
+    def __len__(self):
+        return len(self.batches()) - self.position
+
+def seed_worker(worker_id):
+    """
+    worker_init_fn: seeds numpy and random (used by the masking) from the torch seed that
+    DataLoader gives every worker, so that workers mask differently but reproducibly.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+class ResumableDataLoader(DataLoader):
+    """
+    DataLoader over a BucketBatchSampler. Every pass draws the worker seeds from the sampler
+    seed, rank, epoch and position, so a resumed run masks like any other run resumed at the
+    same point, and different processes and epochs mask differently. Without workers the
+    main process RNGs are seeded the same way.
+    """
+    def __iter__(self):
+        sampler = self.batch_sampler
+        seed = int(np.random.SeedSequence([sampler.seed, sampler.rank, sampler.epoch, sampler.position]).generate_state(1)[0])
+        self.generator = torch.Generator().manual_seed(seed)
+        if self.num_workers == 0:
+            np.random.seed(seed)
+            random.seed(seed)
+        return super().__iter__()
+
 def build_dataloader(df,
                      validation=False,
                      batch_size=4,
                      num_workers=1,
                      device='cpu',
                      collate_config={},
-                     dataset_config={}):
+                     dataset_config={},
+                     sampler_config=None,
+                     packing_config=None,
+                     encoded=False,
+                     num_replicas=1,
+                     rank=0,
+                     seed=0):
+    """
+    Args:
+      df: processed dataset, or the path of an encoded corpus if `encoded` is true.
+      sampler_config (dict): if given, batches of similar length come from a BucketBatchSampler
+        built with these arguments (plus `lengths_cache`, the .npy file caching the sample lengths).
+        Otherwise the batches are shuffled without regard to length.
+      packing_config (dict): if given, short samples are packed into full rows by PackedDataset
+        and collated with PackingCollater (`lengths_cache` as above).
+      num_replicas (int), rank (int): every process loads its strided share of each global batch,
+        see BucketBatchSampler. Do not pass the loader to `accelerator.prepare`.
+      seed (int): seed of the data order and of the masking.
+    
+    The data order can be saved and restored with `loader.batch_sampler.state_dict()` and
+    `load_state_dict()`.
+    """
 
-    dataset = FilePathDataset(df, **dataset_config)
+    if encoded:
+        dataset = EncodedPhonemeDataset(df, **dataset_config)
+    else:
+        dataset = FilePathDataset(df, **dataset_config)
     collate_fn = Collater(**collate_config)
-    data_loader = DataLoader(dataset,
-                             batch_size=batch_size,
-                             shuffle=(not validation),
-                             num_workers=num_workers,
-                             drop_last=(not validation),
-                             collate_fn=collate_fn,
-                             pin_memory=(device != 'cpu'))
+    max_length = dataset.max_mel_length
+    
+    if packing_config is not None:
+        if sampler_config is not None:
+            raise ValueError('packing and bucketing cannot be combined')
+        dataset = PackedDataset(dataset, load_lengths(dataset, packing_config.get('lengths_cache')))
+        collate_fn = PackingCollater()
+    
+    if sampler_config is not None:
+        sampler_config = dict(sampler_config)
+        lengths = load_lengths(dataset, sampler_config.pop('lengths_cache', None))
+    else:
+        # equal lengths and single-batch buckets: plain shuffled batches
+        sampler_config = {'bucket_size': 1}
+        lengths = np.zeros(len(dataset), dtype=np.int64)
+    sampler_config.setdefault('batch_size', batch_size)
+    sampler_config.setdefault('num_replicas', num_replicas)
+    sampler_config.setdefault('rank', rank)
+    sampler_config.setdefault('seed', seed)
+    batch_sampler = BucketBatchSampler(lengths,
+                                       max_length=max_length,
+                                       shuffle=(not validation),
+                                       drop_last=(not validation),
+                                       **sampler_config)
+    
+    data_loader = ResumableDataLoader(dataset,
+                                      batch_sampler=batch_sampler,
+                                      num_workers=num_workers,
+                                      collate_fn=collate_fn,
+                                      worker_init_fn=seed_worker,
+                                      pin_memory=(device != 'cpu'))
 
     return data_loader
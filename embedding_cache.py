@@ -0,0 +1,178 @@
+#coding: utf-8
+"""
+Content-addressed text -> embedding cache in front of PLBertEncoder.
+
+Every stage is cached on its own:
+  raw text        -> normalized text   (model independent)
+  normalized text -> phonemes          (model independent)
+  normalized text -> hidden states     (keyed on the checkpoint hash as well)
+so switching to a new checkpoint only invalidates the encoder outputs.
+
+Usage:
+    encoder = CachedEncoder(PLBertEncoder.from_checkpoint(path, config), file_hash(path), cache_dir="embedding_cache")
+    hidden_states = encoder.encode(["Hello world!"])
+"""
+
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from checkpoint import file_hash
+
+def nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    return len(value.encode('utf-8'))
+
+class ByteLRU(object):
+    """
+    LRU dict bounded by the total size of its keys and values in bytes (the text caches are
+    keyed by the raw input text, which can be as large as the values).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        size = nbytes(key) + nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.items:
+            self.size -= nbytes(key) + nbytes(self.items.pop(key))
+        self.items[key] = value
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted_key, evicted = self.items.popitem(last=False)
+            self.size -= nbytes(evicted_key) + nbytes(evicted)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.items), 'bytes': self.size}
+
+class DiskTier(object):
+    """
+    One .npy file per key under `directory`, written atomically so that several
+    processes can share the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.from_numpy(np.load(path))
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, value.numpy())
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+class CachedEncoder(object):
+    """
+    Args:
+      encoder (PLBertEncoder): the encoder to cache.
+      checkpoint_hash (str): identifies the weights, e.g. `file_hash(checkpoint_path)`.
+      max_bytes (int): memory budget of the hidden states.
+      cache_dir (str): optional directory for the on-disk tier of the hidden states.
+      text_max_bytes (int): memory budget of each of the normalization and phonemization caches.
+    """
+
+    def __init__(self, encoder, checkpoint_hash, max_bytes=1 << 30, cache_dir=None, text_max_bytes=64 << 20):
+        self.encoder = encoder
+        self.checkpoint_hash = checkpoint_hash
+        self.normalized = ByteLRU(text_max_bytes)
+        self.phonemes = ByteLRU(text_max_bytes)
+        self.hidden_states = ByteLRU(max_bytes)
+        self.disk = DiskTier(cache_dir) if cache_dir is not None else None
+
+    def set_encoder(self, encoder, checkpoint_hash):
+        """
+        Switches to new weights, the text caches stay valid.
+        """
+        self.encoder = encoder
+        self.checkpoint_hash = checkpoint_hash
+
+    def key(self, normalized_text):
+        return hashlib.sha256((self.checkpoint_hash + '\0' + normalized_text).encode('utf-8')).hexdigest()
+
+    def normalize(self, texts):
+        return self._stage(self.normalized, texts, self.encoder.normalize)
+
+    def phonemize(self, normalized_texts):
+        return self._stage(self.phonemes, normalized_texts, self.encoder.phonemize_normalized)
+
+    def _stage(self, cache, inputs, fn):
+        outputs = [cache.get(x) for x in inputs]
+        missing = list(dict.fromkeys(x for x, y in zip(inputs, outputs) if y is None))
+        if len(missing) > 0:
+            computed = dict(zip(missing, fn(missing)))
+            for x, y in computed.items():
+                cache.put(x, y)
+            outputs = [computed[x] if y is None else y for x, y in zip(inputs, outputs)]
+        return outputs
+
+    def encode(self, texts):
+        """
+        Same as PLBertEncoder.encode. The returned tensors are shared with the cache, do not modify them.
+        """
+        normalized = self.normalize(texts)
+        keys = [self.key(text) for text in normalized]
+
+        outputs = []
+        for key in keys:
+            hidden_states = self.hidden_states.get(key)
+            if hidden_states is None and self.disk is not None:
+                hidden_states = self.disk.get(key)
+                if hidden_states is not None:
+                    self.hidden_states.put(key, hidden_states)
+            outputs.append(hidden_states)
+
+        missing = list(dict.fromkeys((key, text) for key, text, y in zip(keys, normalized, outputs) if y is None))
+        if len(missing) > 0:
+            phonemes = self.phonemize([text for _, text in missing])
+            # clone so the cache does not keep the whole padded batch alive through views
+            computed = {key: hidden_states.clone() for (key, _), hidden_states in zip(missing, self.encoder.encode_phonemes(phonemes))}
+            for key, hidden_states in computed.items():
+                self.hidden_states.put(key, hidden_states)
+                if self.disk is not None:
+                    self.disk.put(key, hidden_states)
+            outputs = [computed[key] if y is None else y for key, y in zip(keys, outputs)]
+        return outputs
+
+    def stats(self):
+        stats = {'normalized': self.normalized.stats(),
+                 'phonemes': self.phonemes.stats(),
+                 'hidden_states': self.hidden_states.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
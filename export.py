@@ -0,0 +1,137 @@
+#coding: utf-8
+"""
+CPU serving variants of the PL-BERT encoder: dynamic int8 quantization of the Linear
+layers and TorchScript / ONNX export with dynamic batch size and sequence length.
+Every export is checked against the fp32 model by the cosine similarity of its hidden states.
+
+Usage:
+    python export.py --checkpoint Checkpoint/step_1000000.t7 --config Checkpoint/config.yml --quantize --torchscript plbert_int8.pt
+    python export.py --checkpoint Checkpoint/step_1000000.t7 --config Checkpoint/config.yml --onnx plbert.onnx
+"""
+
+import argparse
+
+import torch
+from torch import nn
+
+class HiddenStates(nn.Module):
+    """
+    AlbertModel with a plain (phonemes, attention_mask) -> last_hidden_state signature, for tracing.
+    """
+    def __init__(self, bert):
+        super().__init__()
+        self.bert = bert
+
+    def forward(self, phonemes, attention_mask):
+        return self.bert(phonemes, attention_mask=attention_mask).last_hidden_state
+
+def quantize(bert):
+    """
+    Dynamic int8 quantization of every Linear layer of `bert` (weights int8, activations
+    quantized on the fly), returns a new CPU model.
+    """
+    return torch.ao.quantization.quantize_dynamic(bert.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+def example_inputs(bert, batch_size=2, length=64):
+    phonemes = torch.randint(1, bert.config.vocab_size, (batch_size, length))
+    attention_mask = torch.ones((batch_size, length), dtype=torch.long)
+    attention_mask[1:, length // 2:] = 0
+    return phonemes, attention_mask
+
+def export_torchscript(bert, path):
+    """
+    Traces `bert` (fp32 or quantized) and saves it to `path`, load it with `torch.jit.load`.
+    Sizes are traced symbolically, so any batch size and length up to max_position_embeddings work.
+    """
+    with torch.inference_mode():
+        traced = torch.jit.trace(HiddenStates(bert).eval(), example_inputs(bert), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+def export_onnx(bert, path, opset_version=17):
+    """
+    Exports fp32 `bert` to ONNX with dynamic batch and length axes, run it with onnxruntime.
+    """
+    torch.onnx.export(HiddenStates(bert).eval(), example_inputs(bert), path,
+                      input_names=['phonemes', 'attention_mask'],
+                      output_names=['last_hidden_state'],
+                      dynamic_axes={'phonemes': {0: 'batch', 1: 'length'},
+                                    'attention_mask': {0: 'batch', 1: 'length'},
+                                    'last_hidden_state': {0: 'batch', 1: 'length'}},
+                      opset_version=opset_version,
+                      dynamo=False)
+
+class OnnxEncoder(object):
+    """
+    onnxruntime session with the calling convention of HiddenStates.
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, phonemes, attention_mask):
+        outputs = self.session.run(None, {'phonemes': phonemes.numpy(), 'attention_mask': attention_mask.numpy()})
+        return torch.from_numpy(outputs[0])
+
+def cosine_similarity(reference, candidate, phonemes, attention_mask):
+    """
+    Per-position cosine similarity of the hidden states of two (phonemes, attention_mask) -> hidden
+    state callables, at the unpadded positions only.
+    """
+    with torch.inference_mode():
+        expected = reference(phonemes, attention_mask)
+        actual = candidate(phonemes, attention_mask)
+    mask = attention_mask.bool()
+    return torch.nn.functional.cosine_similarity(expected[mask], actual[mask], dim=-1)
+
+def check_parity(reference, candidate, vocab_size, lengths=(16, 64, 256, 512), batch_size=4, min_cosine=0.99, seed=0):
+    """
+    Compares `candidate` to the fp32 `reference` on random batches of every length in `lengths`,
+    with the last sample of each batch half padded. Raises AssertionError if the cosine similarity
+    of any position is below `min_cosine`, returns {length: (mean, min)} otherwise.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    results = {}
+    for length in lengths:
+        phonemes = torch.randint(1, vocab_size, (batch_size, length), generator=generator)
+        attention_mask = torch.ones((batch_size, length), dtype=torch.long)
+        attention_mask[-1, max(length // 2, 1):] = 0
+        cosine = cosine_similarity(reference, candidate, phonemes, attention_mask)
+        results[length] = (cosine.mean().item(), cosine.min().item())
+        assert results[length][1] >= min_cosine, 'cosine similarity %.4f at length %d, below %.4f' % (results[length][1], length, min_cosine)
+    return results
+
+if __name__ == '__main__':
+    from inference import PLBertEncoder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization of the Linear layers')
+    parser.add_argument('--torchscript', default=None, help='save a TorchScript module to this path')
+    parser.add_argument('--onnx', default=None, help='save an ONNX model to this path (fp32 only)')
+    parser.add_argument('--min_cosine', type=float, default=0.99)
+    args = parser.parse_args()
+
+    bert = PLBertEncoder.from_checkpoint(args.checkpoint, args.config).bert
+    reference = HiddenStates(bert).eval()
+    vocab_size = bert.config.vocab_size
+    lengths = [l for l in (16, 64, 256, 512) if l <= bert.config.max_position_embeddings]
+
+    model = quantize(bert) if args.quantize else bert
+    if args.quantize:
+        print('int8:        %s' % check_parity(reference, HiddenStates(model).eval(), vocab_size, lengths, min_cosine=args.min_cosine))
+    if args.torchscript is not None:
+        traced = export_torchscript(model, args.torchscript)
+        print('torchscript: %s' % check_parity(reference, traced, vocab_size, lengths, min_cosine=args.min_cosine))
+        print('Saved %s' % args.torchscript)
+    if args.onnx is not None:
+        if args.quantize:
+            parser.error('--onnx exports the fp32 model, quantize it with onnxruntime.quantization instead')
+        export_onnx(bert, args.onnx)
+        print('onnx:        %s' % check_parity(reference, OnnxEncoder(args.onnx), vocab_size, lengths, min_cosine=args.min_cosine))
+        print('Saved %s' % args.onnx)
@@ -0,0 +1,177 @@
+#coding: utf-8
+"""
+Inference-only PL-BERT encoder: text -> per-phoneme hidden states.
+
+Usage:
+    encoder = PLBertEncoder.from_checkpoint("Checkpoint/step_1000000.t7", "Checkpoint/config.yml")
+    encoder = PLBertEncoder.from_checkpoint("plbert.safetensors") # written by slim_checkpoint.py
+    hidden_states = encoder.encode(["Hello world, this is PL-BERT."])
+"""
+
+import json
+from collections import OrderedDict
+
+import yaml
+import torch
+from transformers import AlbertConfig, AlbertModel
+
+from text_utils import TextCleaner
+
+def load_config(config):
+    if isinstance(config, dict):
+        return config
+    with open(config) as f:
+        return yaml.safe_load(f)
+
+def encoder_state_dict(state_dict):
+    """
+    Keeps the ALBERT weights of a MultiTaskModel state dict and strips the `module.`
+    (DistributedDataParallel) and `encoder.` prefixes, dropping both prediction heads.
+    """
+    new_state_dict = OrderedDict()
+    for k, v in state_dict.items():
+        if k.startswith('module.'):
+            k = k[7:] # remove `module.`
+        if k.startswith('encoder.'):
+            new_state_dict[k[8:]] = v # remove `encoder.`
+    return new_state_dict
+
+def load_safetensors(path):
+    """
+    Memory-maps an encoder-only safetensors file, returns (state_dict, config). The tensors are
+    views of the file, so pages are only read when a weight is first used and are shared by
+    every process that loads the same file.
+    """
+    from safetensors import safe_open
+    from safetensors.torch import load_file
+    with safe_open(path, framework='pt') as f:
+        metadata = f.metadata() or {}
+    config = json.loads(metadata['config']) if 'config' in metadata else None
+    return load_file(path), config
+
+class PLBertEncoder(object):
+    """
+    Args:
+      bert (AlbertModel): the pre-trained encoder.
+      config (dict): training config, for the phonemizer tokenizer and token separator.
+      global_phonemizer, tokenizer: phonemizer backend and tokenizer of phonemize.phonemize,
+        created from the config on first use if not given.
+      batch_size (int): number of sentences per forward pass.
+    """
+
+    def __init__(self, bert, config, global_phonemizer=None, tokenizer=None, batch_size=32, device='cpu'):
+        self.bert = bert.to(device).eval()
+        self.config = config
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = bert.config.max_position_embeddings
+        self.token_separator = config['dataset_params']['token_separator']
+        self.text_cleaner = TextCleaner()
+        self._global_phonemizer = global_phonemizer
+        self._tokenizer = tokenizer
+
+    @classmethod
+    def from_checkpoint(cls, path, config=None, dtype=None, **kwargs):
+        """
+        Loads the encoder of a `step_*.t7` training checkpoint, or of a `.safetensors` file of
+        slim_checkpoint.py whose config is used if `config` is not given. The safetensors weights
+        are used in place without a copy, unless `dtype` asks for a cast (e.g. torch.float32 for
+        an fp16 file on CPU).
+        """
+        if path.endswith('.safetensors'):
+            state_dict, file_config = load_safetensors(path)
+            config = load_config(config if config is not None else file_config)
+        else:
+            config = load_config(config)
+            # mmap so that the optimizer state and the word predictor are never read
+            state_dict = encoder_state_dict(torch.load(path, map_location='cpu', mmap=True)['net'])
+
+        if dtype is not None:
+            state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+        bert = AlbertModel(AlbertConfig(**config['model_params']))
+        # strict=False only for the position_ids buffer that older checkpoints (and transformers) still have
+        missing = [k for k in bert.load_state_dict(state_dict, strict=False, assign=True).missing_keys if k != 'embeddings.position_ids']
+        if len(missing) > 0:
+            raise KeyError('checkpoint %s has no encoder weights for %s' % (path, ', '.join(sorted(missing))))
+        return cls(bert, config, **kwargs)
+
+    @property
+    def global_phonemizer(self):
+        if self._global_phonemizer is None:
+            import phonemizer
+            self._global_phonemizer = phonemizer.backend.EspeakBackend(language='en-us', preserve_punctuation=True,  with_stress=True)
+        return self._global_phonemizer
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import TransfoXLTokenizer
+            self._tokenizer = TransfoXLTokenizer.from_pretrained(self.config['dataset_params']['tokenizer'])
+        return self._tokenizer
+
+    def normalize(self, texts):
+        from text_normalize import normalize_text, remove_accents
+        return [normalize_text(remove_accents(text)) for text in texts]
+
+    def phonemize_normalized(self, texts):
+        """
+        Phonemizes normalized `texts`, returns one phoneme string per text.
+        """
+        from phonemize import phonemize_normalized_batch
+        outputs = phonemize_normalized_batch(texts, self.global_phonemizer, self.tokenizer)
+        return [self.token_separator.join(output['phonemes']) for output in outputs]
+
+    def phonemize(self, texts):
+        """
+        Normalizes and phonemizes `texts`, returns one phoneme string per text.
+        """
+        return self.phonemize_normalized(self.normalize(texts))
+
+    def encode(self, texts):
+        """
+        Returns a list with a (phonemes, hidden_size) tensor of hidden states per text.
+        """
+        return self.encode_phonemes(self.phonemize(texts))
+
+    def encode_phonemes(self, phonemes):
+        """
+        Same as `encode` for already phonemized strings.
+        """
+        return self.encode_ids([self.text_cleaner(p) for p in phonemes])
+
+    def encode_ids(self, ids):
+        """
+        Same as `encode` for TextCleaner ids. Inputs without phonemes (e.g. empty or punctuation-only
+        text) get an empty (0, hidden_size) tensor.
+        """
+        for i, x in enumerate(ids):
+            if len(x) > self.max_length:
+                raise ValueError('input %d has %d phonemes, more than the %d positions of the encoder' % (i, len(x), self.max_length))
+
+        outputs = [None] * len(ids)
+        for i, x in enumerate(ids):
+            if len(x) == 0:
+                outputs[i] = torch.zeros((0, self.bert.config.hidden_size), dtype=self.bert.embeddings.word_embeddings.weight.dtype)
+
+        # batch sentences of similar length together to minimize padding
+        order = sorted((i for i in range(len(ids)) if len(ids[i]) > 0), key=lambda i: len(ids[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, hidden_states in zip(batch, self.forward_batch([ids[i] for i in batch])):
+                outputs[i] = hidden_states
+        return outputs
+
+    def forward_batch(self, ids):
+        """
+        One padded forward pass over all of `ids`, returns the unpadded hidden states.
+        """
+        lengths = [len(x) for x in ids]
+        phonemes = torch.zeros((len(ids), max(lengths)), dtype=torch.long)
+        attention_mask = torch.zeros((len(ids), max(lengths)), dtype=torch.long)
+        for bid, x in enumerate(ids):
+            phonemes[bid, :lengths[bid]] = torch.as_tensor(x, dtype=torch.long)
+            attention_mask[bid, :lengths[bid]] = 1
+
+        with torch.inference_mode():
+            hidden_states = self.bert(phonemes.to(self.device), attention_mask=attention_mask.to(self.device)).last_hidden_state.cpu()
+        return [hidden_states[bid, :lengths[bid]] for bid in range(len(ids))]
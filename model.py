@@ -1,18 +1,172 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+def linear_cross_entropy(hidden, weight, bias, targets):
+    return F.cross_entropy(F.linear(hidden, weight, bias), targets, reduction='none')
+
+def chunked_cross_entropy(hidden, linear, targets, chunk_size=512):
+    """
+    Per-position cross entropy of `linear(hidden)` computed `chunk_size` positions at a time.
+    Every chunk is checkpointed, so neither the forward nor the backward pass holds more
+    than one chunk of logits.
+    """
+    losses = [checkpoint(linear_cross_entropy, hidden[i:i + chunk_size], linear.weight, linear.bias, targets[i:i + chunk_size], use_reentrant=False)
+              for i in range(0, hidden.size(0), chunk_size)]
+    return torch.cat(losses) if len(losses) > 0 else hidden.new_zeros(0)
+
+def sampled_cross_entropy(hidden, linear, targets, num_sampled=8192):
+    """
+    Sampled softmax: the logits are only computed for the targets of the batch plus
+    `num_sampled` uniformly drawn words shared by all positions.
+    """
+    negatives = torch.randint(0, linear.out_features, (num_sampled,), device=targets.device)
+    candidates, inverse = torch.unique(torch.cat([targets, negatives]), return_inverse=True)
+    logits = F.linear(hidden, linear.weight[candidates], linear.bias[candidates])
+    return F.cross_entropy(logits, inverse[:targets.size(0)], reduction='none')
 
 class MultiTaskModel(nn.Module):
-    def __init__(self, model, num_tokens=178, num_vocab=84827, hidden_size=768):
+    """
+    Args:
+      vocab_loss (str): how word losses are computed when `word_targets` are given:
+        "full" projects the selected positions to the whole vocabulary,
+        "chunked" does the same in checkpointed chunks of `vocab_chunk_size` positions,
+        "sampled" uses a sampled softmax with `num_sampled` negatives (in training only,
+        evaluation falls back to "chunked").
+    """
+    def __init__(self, model, num_tokens=178, num_vocab=84827, hidden_size=768,
+                 vocab_loss="full", vocab_chunk_size=512, num_sampled=8192):
         super().__init__()
 
         self.encoder = model
         self.mask_predictor = nn.Linear(hidden_size, num_tokens)
         self.word_predictor = nn.Linear(hidden_size, num_vocab)
-    
-    def forward(self, phonemes, attention_mask=None):
-        output = self.encoder(phonemes, attention_mask=attention_mask)
+        
+        self.vocab_loss = vocab_loss
+        self.vocab_chunk_size = vocab_chunk_size
+        self.num_sampled = num_sampled
+
+    def forward(self, phonemes, attention_mask=None, position_ids=None, word_mask=None, word_targets=None, segment_ids=None):
+        """
+        For packed rows, pass the (batch, length) `segment_ids` of PackingCollater instead of
+        `attention_mask`, so that the packed samples never attend to each other.
+        Without `word_mask`, returns phoneme and word logits at every position.
+        With a (batch, length) bool `word_mask`, the word head is only applied at those positions
+        and `words_pred` is (positions, num_vocab); if `word_targets` of these positions are given
+        too, `words_pred` is their per-position cross entropy instead of logits.
+        """
+        if segment_ids is not None:
+            output = self.encode_packed(phonemes, segment_ids, position_ids)
+        else:
+            output = self.encoder(phonemes, attention_mask=attention_mask, position_ids=position_ids)
         tokens_pred = self.mask_predictor(output.last_hidden_state)
-        words_pred = self.word_predictor(output.last_hidden_state)
         
-        return tokens_pred, words_pred
\ No newline at end of file
+        if word_mask is None:
+            words_pred = self.word_predictor(output.last_hidden_state)
+            return tokens_pred, words_pred
+        
+        hidden = output.last_hidden_state[word_mask]
+        if word_targets is None:
+            words_pred = self.word_predictor(hidden)
+        elif self.vocab_loss == "sampled" and self.training:
+            words_pred = sampled_cross_entropy(hidden, self.word_predictor, word_targets, self.num_sampled)
+        elif self.vocab_loss in ("chunked", "sampled"):
+            words_pred = chunked_cross_entropy(hidden, self.word_predictor, word_targets, self.vocab_chunk_size)
+        else:
+            words_pred = F.cross_entropy(self.word_predictor(hidden), word_targets, reduction='none')
+
+        return tokens_pred, words_pred
+
+    def encode_packed(self, phonemes, segment_ids, position_ids=None):
+        # AlbertModel only broadcasts (batch, length) masks, so apply the block-diagonal mask of
+        # packed rows to its embeddings and transformer directly. The mask is built here, on the
+        # device and in the encoder dtype, from the segment ids (0 is padding)
+        dtype = self.encoder.dtype
+        same_segment = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] > 0)
+        extended_attention_mask = torch.zeros(same_segment.shape, dtype=dtype, device=segment_ids.device)
+        extended_attention_mask = extended_attention_mask.masked_fill_(~same_segment, torch.finfo(dtype).min)[:, None]
+
+        embedding_output = self.encoder.embeddings(phonemes, position_ids=position_ids)
+        return self.encoder.encoder(embedding_output,
+                                    extended_attention_mask,
+                                    head_mask=[None] * self.encoder.config.num_hidden_layers)
+
+class MultiTaskLoss(nn.Module):
+    """
+    Masked phoneme and word prediction losses of a padded batch in one pass each.
+
+    Args:
+      per_sample (bool): average every sample first and then the batch, like the original
+        training loop (the token loss is divided by the number of samples with masked
+        positions plus one). If false, average over all positions of the batch. For packed
+        rows pass their `position_ids`, so that every packed sample is averaged on its own.
+      word_sample_prob (float): if set, `word_mask` keeps only this fraction of the real
+        positions for the word loss.
+    """
+    def __init__(self, per_sample=True, word_sample_prob=None):
+        super().__init__()
+        self.per_sample = per_sample
+        self.word_sample_prob = word_sample_prob
+    
+    def word_mask(self, input_lengths, max_length, device=None):
+        """
+        (batch, length) bool mask of the positions to predict words at, to pass to MultiTaskModel.
+        """
+        input_lengths = torch.as_tensor(input_lengths, device=device)
+        mask = torch.arange(max_length, device=device)[None, :] < input_lengths[:, None]
+        if self.word_sample_prob is not None:
+            mask &= torch.rand(mask.shape, device=device) < self.word_sample_prob
+        return mask
+
+    def forward(self, tokens_pred, words_pred, labels, words, input_lengths, masked, word_mask=None, position_ids=None):
+        """
+        Args:
+          tokens_pred: (batch, length, classes) phoneme logits of MultiTaskModel.
+          words_pred: (batch, length, classes) word logits, or the (positions, classes) logits or
+            (positions,) losses at `word_mask` when MultiTaskModel was called with it.
+          labels, words: (batch, length) phoneme and word targets.
+          input_lengths: length of every sample, list or tensor.
+          masked: (batch, length) bool tensor of the positions to predict phonemes for.
+          word_mask: (batch, length) bool tensor of the positions of `words_pred`, see `word_mask()`.
+          position_ids: (batch, length) positions of PackingCollater, restarting at 0 for every
+            packed sample, to average per sample instead of per row.
+        """
+        batch_size, max_length = words.shape
+        input_lengths = torch.as_tensor(input_lengths, device=words.device)
+        text_mask = torch.arange(max_length, device=words.device)[None, :] < input_lengths[:, None]
+        masked = masked.to(words.device) & text_mask
+
+        # only gather the positions that count before the cross entropy
+        if word_mask is None:
+            word_mask = text_mask
+            loss_vocab = F.cross_entropy(words_pred[text_mask], words[text_mask], reduction='none')
+        elif words_pred.dim() == 2:
+            loss_vocab = F.cross_entropy(words_pred, words[word_mask], reduction='none')
+        else:
+            loss_vocab = words_pred
+        loss_token = F.cross_entropy(tokens_pred[masked], labels[masked], reduction='none')
+
+        if not self.per_sample:
+            return loss_vocab.mean(), (loss_token.mean() if loss_token.numel() > 0 else loss_token.sum())
+
+        # the sample of every position: its row, or its segment of a packed row
+        rows = torch.arange(batch_size, device=words.device)[:, None].expand(batch_size, max_length)
+        if position_ids is None:
+            samples, num_samples = rows, batch_size
+        else:
+            segments = ((position_ids.to(words.device) == 0) & text_mask).long().cumsum(dim=1) - 1
+            samples, num_samples = rows * max_length + segments.clamp(min=0), batch_size * max_length
+
+        vocab_samples = samples[word_mask]
+        token_samples = samples[masked]
+        num_words = torch.bincount(vocab_samples, minlength=num_samples)
+        num_masked = torch.bincount(token_samples, minlength=num_samples)
+
+        loss_vocab = torch.zeros(num_samples, device=words.device, dtype=loss_vocab.dtype).index_add_(0, vocab_samples, loss_vocab)
+        loss_vocab = (loss_vocab / num_words.clamp(min=1)).sum() / (num_words > 0).sum().clamp(min=1)
+
+        loss_token = torch.zeros(num_samples, device=words.device, dtype=loss_token.dtype).index_add_(0, token_samples, loss_token)
+        loss_token = (loss_token / num_masked.clamp(min=1)).sum() / ((num_masked > 0).sum() + 1)
+
+        return loss_vocab, loss_token
@@ -0,0 +1,145 @@
+#coding: utf-8
+
+import os
+import sqlite3
+from collections import OrderedDict
+
+class PhonemeCache:
+    """
+    word -> phonemes cache, an in-process LRU in front of an optional SQLite store.
+
+    The store can be shared by several processes (e.g. the ProcessPool workers of the
+    preprocessing notebook): every process opens its own connection and the database
+    runs in WAL mode, so readers never block the single writer.
+
+    Args:
+      path (str): SQLite file, None for a memory-only cache.
+      language (str), with_stress (bool), preserve_punctuation (bool): phonemizer settings,
+        part of the key so entries from different settings never mix.
+      max_size (int): number of words kept in the in-process LRU.
+    """
+
+    def __init__(self, path=None, language='en-us', with_stress=True, preserve_punctuation=True, max_size=200000):
+        self.path = path
+        self.settings = "%s|stress=%d|punct=%d" % (language, with_stress, preserve_punctuation)
+        self.max_size = max_size
+        self.memory = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = None
+        self._pid = None
+        if path is not None:
+            self._connect()
+
+    def _connect(self):
+        # connections must not cross a fork, reopen lazily in every worker process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS phonemes ("
+                               "settings TEXT NOT NULL, word TEXT NOT NULL, phonemes TEXT NOT NULL, "
+                               "PRIMARY KEY (settings, word)) WITHOUT ROWID")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    def _remember(self, word, phonemes):
+        self.memory[word] = phonemes
+        self.memory.move_to_end(word)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, words):
+        """
+        Returns a dict with the cached phonemes of `words`, missing words are left out.
+        """
+        words = list(dict.fromkeys(words))
+        found = {}
+        missing = []
+        for word in words:
+            if word in self.memory:
+                self.memory.move_to_end(word)
+                found[word] = self.memory[word]
+                self.hits += 1
+            else:
+                missing.append(word)
+
+        if self.path is not None and len(missing) > 0:
+            conn = self._connect()
+            # stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = conn.execute("SELECT word, phonemes FROM phonemes WHERE settings = ? AND word IN (%s)"
+                                    % ','.join('?' * len(chunk)), [self.settings] + chunk).fetchall()
+                for word, phonemes in rows:
+                    found[word] = phonemes
+                    self._remember(word, phonemes)
+                self.disk_hits += len(rows)
+
+        self.misses += len(words) - len(found)
+        return found
+
+    def put_many(self, items):
+        items = list(items)
+        for word, phonemes in items:
+            self._remember(word, phonemes)
+        if self.path is not None and len(items) > 0:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO phonemes (settings, word, phonemes) VALUES (?, ?, ?)",
+                                 [(self.settings, word, phonemes) for word, phonemes in items])
+
+    def load_lexicon(self, lexicon_path):
+        """
+        Warm-start from a pre-built lexicon with one `word<TAB>phonemes` entry per line.
+        """
+        items = []
+        with open(lexicon_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if '\t' not in line:
+                    continue
+                word, phonemes = line.split('\t', 1)
+                items.append((word, phonemes))
+        self.put_many(items)
+        return len(items)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / max(lookups, 1),
+                'memory_size': len(self.memory)}
+
+class CachedPhonemizer:
+    """
+    Wraps a phonemizer backend so that only words missing from `cache` reach it.
+    Drop-in replacement for `global_phonemizer` in phonemize.phonemize.
+    """
+
+    def __init__(self, global_phonemizer, cache):
+        self.global_phonemizer = global_phonemizer
+        self.cache = cache
+
+    def phonemize(self, text, strip=True):
+        if not strip:
+            return self.global_phonemizer.phonemize(text, strip=strip)
+
+        found = self.cache.get_many(text)
+        missing = [word for word in dict.fromkeys(text) if word not in found]
+        if len(missing) > 0:
+            new = dict(zip(missing, self.global_phonemizer.phonemize(missing, strip=strip)))
+            self.cache.put_many(new.items())
+            found.update(new)
+        return [found[word] for word in text]
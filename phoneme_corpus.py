@@ -0,0 +1,133 @@
+#coding: utf-8
+"""
+Pre-encoded phoneme corpus, so that training does not run TextCleaner on every sample.
+
+A corpus directory holds flat little-endian arrays that are memory-mapped at train time:
+  symbols.bin          uint8  TextCleaner ids of all phonemes, words back to back, no separators
+  word_offsets.bin     int64  start of every word in symbols.bin (num_words + 1 entries)
+  tokens.bin           int32  token-map id of every word
+  article_offsets.bin  int64  start of every article in tokens.bin (num_articles + 1 entries)
+  meta.json            sizes and the token-map id of the word separator
+
+Usage:
+    python phoneme_corpus.py --output wikipedia_20220301.en.encoded
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+from text_utils import TextCleaner
+from token_maps import load_token_maps, lookup as lookup_tokens
+
+def encode_corpus(dataset, output_dir, token_maps, word_separator=3039, flush_every=10000):
+    """
+    Converts a phonemized dataset (rows of `phonemes` and `input_ids`, as written by the
+    preprocessing notebook) into the layout above. `token_maps` is the dense array of token_maps.py.
+    Memory is bounded by `flush_every` articles.
+    """
+    text_cleaner = TextCleaner()
+    os.makedirs(output_dir, exist_ok=True)
+
+    files = {name: open(os.path.join(output_dir, name + '.bin'), 'wb')
+             for name in ['symbols', 'word_offsets', 'tokens', 'article_offsets']}
+
+    num_symbols = 0
+    num_words = 0
+    num_articles = 0
+    files['word_offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+    files['article_offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+
+    symbols, lengths, tokens, words_per_article = [], [], [], []
+    def flush():
+        files['symbols'].write(np.array(symbols, dtype=np.uint8).tobytes())
+        files['word_offsets'].write((num_symbols - sum(lengths) + np.cumsum(lengths, dtype=np.int64)).astype('<i8').tobytes())
+        files['tokens'].write(np.array(tokens, dtype='<i4').tobytes())
+        files['article_offsets'].write((num_words - sum(words_per_article) + np.cumsum(words_per_article, dtype=np.int64)).astype('<i8').tobytes())
+        for buffer in [symbols, lengths, tokens, words_per_article]:
+            buffer.clear()
+
+    for sample in dataset:
+        phonemes = sample['phonemes']
+        symbols.extend(text_cleaner(''.join(phonemes)))
+        lengths.extend(len(p) for p in phonemes)
+        tokens.extend(lookup_tokens(token_maps, sample['input_ids']).tolist())
+        words_per_article.append(len(phonemes))
+
+        num_symbols += sum(len(p) for p in phonemes)
+        num_words += len(phonemes)
+        num_articles += 1
+        if len(words_per_article) >= flush_every:
+            flush()
+    flush()
+
+    for f in files.values():
+        f.close()
+
+    meta = {'num_articles': num_articles,
+            'num_words': num_words,
+            'num_symbols': num_symbols,
+            'separator_token': int(token_maps[word_separator])}
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+class PhonemeCorpus(object):
+    """
+    Zero-copy reader of an encoded corpus directory. The arrays are mapped lazily so that
+    every DataLoader worker maps the files itself and shares the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.separator_token = self.meta['separator_token']
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            load = lambda name, dtype: np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r')
+            self._arrays = {'symbols': load('symbols', np.uint8),
+                            'word_offsets': load('word_offsets', '<i8'),
+                            'tokens': load('tokens', '<i4'),
+                            'article_offsets': load('article_offsets', '<i8')}
+        return self._arrays
+
+    def __len__(self):
+        return self.meta['num_articles']
+
+    def __getitem__(self, idx):
+        """
+        Returns (symbols, word lengths, token ids) of article `idx`, symbols and tokens are views.
+        """
+        arrays = self.arrays
+        start, end = arrays['article_offsets'][idx], arrays['article_offsets'][idx + 1]
+        word_offsets = arrays['word_offsets'][start:end + 1]
+        symbols = arrays['symbols'][word_offsets[0]:word_offsets[-1]]
+        return symbols, np.diff(word_offsets), arrays['tokens'][start:end]
+
+if __name__ == '__main__':
+    import yaml
+    from preprocess import load_processed
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--data_folder', default=None, help='processed dataset, defaults to data_folder of the config')
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    token_maps = load_token_maps(config['dataset_params']['token_maps'])
+
+    dataset = load_processed(args.data_folder or config['data_folder'])
+    meta = encode_corpus(dataset, args.output, token_maps, word_separator=config['dataset_params']['word_separator'])
+    print('Encoded %d articles, %d words, %d phonemes to %s' % (meta['num_articles'], meta['num_words'], meta['num_symbols'], args.output))
@@ -1,4 +1,5 @@
 import string
+from functools import lru_cache
 from text_normalize import normalize_text, remove_accents
 
 special_mappings = {
@@ -18,11 +19,59 @@ special_mappings = {
     "doesn": "dˈʌzən",
 }
 
+class LookupPhonemizer:
+    """
+    Deterministic stand-in for the espeak backend, for tests and benchmarks.
+
+    Args:
+      lexicon (dict): word -> phonemes, unknown words are returned lower-cased.
+    """
+    def __init__(self, lexicon=None):
+        self.lexicon = lexicon or {}
+        self.num_calls = 0
+
+    def phonemize(self, text, strip=True):
+        self.num_calls += 1
+        return [self.lexicon.get(word, word.lower()) for word in text]
+
+token_id_caches = {}
+
+def get_token_id(tokenizer, max_size=2 ** 18):
+    """
+    Returns a memoized `word -> tokenizer.encode(word)[0]` for `tokenizer`.
+    The memo lives as long as the process, so it is shared by every document of a shard.
+    """
+    key = id(tokenizer)
+    if key not in token_id_caches:
+        # keep a reference to the tokenizer so its id cannot be reused
+        token_id_caches[key] = (tokenizer, lru_cache(maxsize=max_size)(lambda word: tokenizer.encode(word)[0]))
+    return token_id_caches[key][1]
+
+def is_punctuation(word):
+    return word in string.punctuation
+
+def phonemize_words(words_list, global_phonemizer):
+    # phonemize the unique words of all documents in a single backend call
+    unique_words = list(dict.fromkeys(word for words in words_list for word in words if not is_punctuation(word)))
+    lookup = {}
+    if len(unique_words) > 0:
+        lookup = dict(zip(unique_words, global_phonemizer.phonemize(unique_words, strip=True)))
+    return [[word if is_punctuation(word) else lookup[word] for word in words] for words in words_list]
+
 def phonemize(text, global_phonemizer, tokenizer):
-    text = normalize_text(remove_accents(text))
-    words = tokenizer.tokenize(text)
-    
-    phonemes_bad = [global_phonemizer.phonemize([word], strip=True)[0] if word not in string.punctuation else word for word in words]
+    return phonemize_batch([text], global_phonemizer, tokenizer)[0]
+
+def phonemize_batch(texts, global_phonemizer, tokenizer):
+    return phonemize_normalized_batch([normalize_text(remove_accents(text)) for text in texts], global_phonemizer, tokenizer)
+
+def phonemize_normalized_batch(texts, global_phonemizer, tokenizer):
+    # texts have already been through normalize_text
+    words_list = [tokenizer.tokenize(text) for text in texts]
+    phonemes_list = phonemize_words(words_list, global_phonemizer)
+    return [postprocess(words, phonemes_bad, tokenizer) for words, phonemes_bad in zip(words_list, phonemes_list)]
+
+def postprocess(words, phonemes_bad, tokenizer):
+    token_id = get_token_id(tokenizer)
     input_ids = []
     phonemes = []
     
@@ -69,10 +118,10 @@ def phonemize(text, global_phonemizer, tokenizer):
         if "@" in word and len(word) > 1: # remove "@"
             if "@" in word and len(word) > 1:
                 phonemes.append(word.replace('@', ''))
-                input_ids.append(tokenizer.encode(word.replace('@', ''))[0])
+                input_ids.append(token_id(word.replace('@', '')))
                 continue
         
-        input_ids.append(tokenizer.encode(word)[0])
+        input_ids.append(token_id(word))
         phonemes.append(phoneme)
         
     assert len(input_ids) == len(phonemes)
@@ -0,0 +1,467 @@
+#coding: utf-8
+"""
+Streaming version of the preprocessing notebook: normalizes and phonemizes a text dataset
+with a pool of workers and appends the results to a few large Arrow files.
+
+Articles are processed in chunks of `chunk_size` consecutive documents. Finished chunks are
+appended to `part-NNNNN.arrow.tmp`, which is renamed and recorded in `manifest.json` once it
+holds `rows_per_file` rows, so memory is bounded by the chunks in flight and a crash loses at
+most the current file. Rerunning the same command resumes from the manifest.
+
+Idle workers get the next task of a few documents (see Scheduler). A document that
+exceeds the time or memory limit, or raises, is quarantined to `rejects.jsonl` instead of
+failing its chunk.
+
+The output directory is read with `load_processed`, which memory-maps the files without a copy.
+
+Usage:
+    python preprocess.py --output wikipedia_20220301.en.processed --num_workers 32 --phoneme_cache phoneme_cache.sqlite
+"""
+
+import os
+import json
+import hashlib
+import time
+import queue
+import argparse
+import os.path as osp
+import multiprocessing as mp
+from collections import deque
+
+import pyarrow as pa
+
+manifest_name = 'manifest.json'
+rejects_name = 'rejects.jsonl'
+
+def espeak_phonemizer(cache_path=None):
+    import phonemizer
+    global_phonemizer = phonemizer.backend.EspeakBackend(language='en-us', preserve_punctuation=True,  with_stress=True)
+    if cache_path is not None:
+        from phoneme_cache import PhonemeCache, CachedPhonemizer
+        cache = PhonemeCache(cache_path, language='en-us', preserve_punctuation=True, with_stress=True)
+        global_phonemizer = CachedPhonemizer(global_phonemizer, cache)
+    return global_phonemizer
+
+def process_task(indices, dataset, tokenizer, global_phonemizer, doc, deadline, timeout):
+    """
+    Normalizes the documents `indices` one at a time, each within `timeout` seconds (watched by
+    the scheduler through the shared `doc` and `deadline`), then phonemizes them together.
+    Returns (columns of the good documents, [(index, reason)] of the rejected ones, split),
+    `split` is true if the batch failed and should be retried one document at a time.
+    """
+    from text_normalize import normalize_text, remove_accents
+    from phonemize import phonemize_normalized_batch
+
+    columns = dataset[indices]
+    texts = columns.pop('text')
+    keep, normalized, rejects = [], [], []
+    for i, (idx, text) in enumerate(zip(indices, texts)):
+        doc.value = idx
+        deadline.value = time.time() + timeout
+        try:
+            normalized.append(normalize_text(remove_accents(text)))
+            keep.append(i)
+        except MemoryError:
+            rejects.append((idx, 'memory'))
+        except Exception as e:
+            rejects.append((idx, 'error: %r' % e))
+
+    doc.value = -1
+    deadline.value = time.time() + timeout * max(len(keep), 1)
+    try:
+        outputs = phonemize_normalized_batch(normalized, global_phonemizer, tokenizer)
+    except Exception as e:
+        if len(keep) > 1:
+            return None, rejects, True
+        outputs = []
+        rejects.extend((indices[i], 'memory' if isinstance(e, MemoryError) else 'error: %r' % e) for i in keep)
+        keep = []
+    finally:
+        deadline.value = 0
+
+    columns = {k: [v[i] for i in keep] for k, v in columns.items()}
+    columns['input_ids'] = [output['input_ids'] for output in outputs]
+    columns['phonemes'] = [output['phonemes'] for output in outputs]
+    return columns, rejects, False
+
+def worker_main(worker_id, dataset, tokenizer, phonemizer_factory, phonemizer_args, tasks, results,
+                doc, deadline, timeout, max_memory):
+    import resource
+
+    global_phonemizer = phonemizer_factory(*phonemizer_args)
+    if max_memory is not None:
+        # on top of what the libraries already mapped, documents above it raise MemoryError
+        with open('/proc/self/statm') as f:
+            mapped = int(f.read().split()[0]) * resource.getpagesize()
+        resource.setrlimit(resource.RLIMIT_AS, (mapped + max_memory, resource.RLIM_INFINITY))
+
+    while True:
+        item = tasks.get()
+        if item is None:
+            return
+        task_id, indices = item
+        start = time.perf_counter()
+        columns, rejects, split = process_task(indices, dataset, tokenizer, global_phonemizer, doc, deadline, timeout)
+        results.put((worker_id, task_id, columns, rejects, split, time.perf_counter() - start))
+
+class Scheduler(object):
+    """
+    Runs `worker_main` processes and hands every idle worker the next task, so that no task
+    waits behind a slow one. The scheduler knows the task of every worker, a task stays
+    assigned until its result has been received.
+
+    Every worker publishes the document it is normalizing and its deadline in shared memory.
+    A worker past its deadline (or dead, e.g. killed for memory) is replaced, its document is
+    quarantined and the rest of its task is queued again. A task whose batched phonemization
+    fails is queued again one document per task, so that the offending document is found.
+
+    Args:
+      timeout (float): seconds allowed per document.
+      max_memory (int): bytes a worker may allocate on top of its libraries, None for no limit.
+    """
+
+    def __init__(self, dataset, tokenizer, phonemizer_factory, phonemizer_args=(), num_workers=8, timeout=60, max_memory=None):
+        self.context = mp.get_context('spawn')
+        self.args = (dataset, tokenizer, phonemizer_factory, phonemizer_args)
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.results = self.context.Queue()
+        self.workers = [None] * num_workers
+        self.assigned = [None] * num_workers # id of the task of every worker
+        self.stats = [{'documents': 0, 'busy': 0.0, 'restarts': 0} for _ in range(num_workers)]
+        self.pending = {} # id of every task waiting or running -> (chunk, document indices)
+        self.backlog = deque() # ids of the pending tasks no worker has yet
+        self.retried = set() # (chunk, indices) of tasks whose worker died without a result
+        self.next_task_id = 0
+        self.last_check = time.time()
+
+    def start_worker(self, i):
+        tasks, doc, deadline = self.context.Queue(), self.context.Value('q', -1), self.context.Value('d', 0)
+        process = self.context.Process(target=worker_main, args=(i,) + self.args + (tasks, self.results, doc, deadline, self.timeout, self.max_memory))
+        process.start()
+        self.workers[i] = (process, tasks, doc, deadline)
+        self.assigned[i] = None
+
+    def submit(self, chunk, indices):
+        self.pending[self.next_task_id] = (chunk, indices)
+        self.backlog.append(self.next_task_id)
+        self.next_task_id += 1
+
+    def dispatch(self):
+        for i, (_, tasks, _, _) in enumerate(self.workers):
+            while self.assigned[i] is None and len(self.backlog) > 0:
+                task_id = self.backlog.popleft()
+                if task_id in self.pending:
+                    tasks.put((task_id, self.pending[task_id][1]))
+                    self.assigned[i] = task_id
+
+    def check_workers(self):
+        """
+        Replaces stuck or dead workers and queues their tasks again, returns [(chunk, index, reason)]
+        of the documents they were stuck on.
+        """
+        rejects = []
+        for i, (process, _, doc, deadline) in enumerate(self.workers):
+            timed_out = deadline.value > 0 and time.time() > deadline.value
+            if process.is_alive() and not timed_out:
+                continue
+            reason = 'timeout' if timed_out else 'crash (exit code %s)' % process.exitcode
+            process.kill()
+            process.join()
+            self.stats[i]['restarts'] += 1
+
+            task_id = self.assigned[i]
+            if task_id is not None and task_id in self.pending:
+                chunk, indices = self.pending.pop(task_id)
+                key = (chunk, tuple(indices))
+                if doc.value >= 0 and doc.value in indices:
+                    # stuck normalizing one document, the others are retried
+                    rejects.append((chunk, doc.value, reason))
+                    rest = [idx for idx in indices if idx != doc.value]
+                    if len(rest) > 0:
+                        self.submit(chunk, rest)
+                elif deadline.value <= 0 and key not in self.retried:
+                    # died before starting or after finishing, its result may never have left the
+                    # queue's feeder thread: run the task again, once
+                    self.retried.add(key)
+                    self.submit(chunk, indices)
+                elif len(indices) == 1:
+                    rejects.append((chunk, indices[0], reason))
+                else:
+                    # stuck in the batched phonemization, retry one document at a time
+                    for idx in indices:
+                        self.submit(chunk, [idx])
+            self.start_worker(i)
+
+        # stall guard: every pending task must be waiting or assigned, or the run never ends
+        waiting = set(self.backlog) | set(self.assigned)
+        for task_id in [task_id for task_id in self.pending if task_id not in waiting]:
+            self.submit(*self.pending.pop(task_id))
+        return rejects
+
+    def run(self, tasks, max_pending=None):
+        """
+        Yields ('done', chunk, indices, columns) for every finished task, with the document indices
+        of the rows in `columns`, and ('reject', chunk, index, reason) for every quarantined document.
+        `tasks` yields (chunk, indices), at most `max_pending` are pending.
+        """
+        max_pending = max_pending or 4 * self.num_workers
+        tasks = iter(tasks)
+        for i in range(self.num_workers):
+            self.start_worker(i)
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(self.pending) < max_pending:
+                    item = next(tasks, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        self.submit(*item)
+                if exhausted and len(self.pending) == 0:
+                    break
+
+                if time.time() - self.last_check > 1:
+                    self.last_check = time.time()
+                    for chunk, idx, reason in self.check_workers():
+                        yield 'reject', chunk, idx, reason
+                self.dispatch()
+                try:
+                    worker_id, task_id, columns, rejects, split, elapsed = self.results.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                if self.assigned[worker_id] == task_id:
+                    self.assigned[worker_id] = None
+                if task_id not in self.pending:
+                    # late result of a task that check_workers already queued again
+                    continue
+                chunk, indices = self.pending.pop(task_id)
+                self.stats[worker_id]['busy'] += elapsed
+                for idx, reason in rejects:
+                    yield 'reject', chunk, idx, reason
+                if split:
+                    rejected = set(idx for idx, _ in rejects)
+                    for idx in indices:
+                        if idx not in rejected:
+                            self.submit(chunk, [idx])
+                else:
+                    self.stats[worker_id]['documents'] += len(indices)
+                    rejected = set(idx for idx, _ in rejects)
+                    yield 'done', chunk, [idx for idx in indices if idx not in rejected], columns
+        finally:
+            for _, tasks, _, _ in self.workers:
+                tasks.put(None)
+            for process, _, _, _ in self.workers:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.kill()
+
+    def report(self):
+        lines = []
+        for i, stats in enumerate(self.stats):
+            lines.append('worker %d: %d documents, %.1f documents/s busy, %d restarts' %
+                         (i, stats['documents'], stats['documents'] / max(stats['busy'], 1e-9), stats['restarts']))
+        return '\n'.join(lines)
+
+def load_manifest(output_dir, chunk_size, num_documents):
+    path = osp.join(output_dir, manifest_name)
+    if not osp.exists(path):
+        return {'chunk_size': chunk_size, 'num_documents': num_documents, 'files': []}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['chunk_size'] != chunk_size or manifest['num_documents'] != num_documents:
+        raise ValueError('%s was written with chunk_size %d over %d documents, not %d over %d' %
+                         (path, manifest['chunk_size'], manifest['num_documents'], chunk_size, num_documents))
+    return manifest
+
+def manifest_fingerprint(manifest):
+    """
+    Changes whenever the files, or the order of the rows in them, change.
+    """
+    return hashlib.sha256(json.dumps(manifest['files'], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def save_manifest(output_dir, manifest):
+    path = osp.join(output_dir, manifest_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+class PartWriter(object):
+    """
+    Appends record batches to the current part file and commits it to the manifest when full.
+    """
+
+    def __init__(self, output_dir, manifest, schema, rows_per_file):
+        self.output_dir = output_dir
+        self.schema = schema
+        self.manifest = manifest
+        self.rows_per_file = rows_per_file
+        self.writer = None
+
+    def write(self, start, columns):
+        batch = pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        if self.writer is None:
+            self.name = 'part-%05d.arrow' % len(self.manifest['files'])
+            self.sink = pa.OSFile(osp.join(self.output_dir, self.name + '.tmp'), 'wb')
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+            self.chunks = []
+            self.num_rows = 0
+        self.writer.write_batch(batch)
+        self.chunks.append(start)
+        self.num_rows += batch.num_rows
+        if self.num_rows >= self.rows_per_file:
+            self.commit()
+
+    def commit(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.sink.close()
+        os.replace(osp.join(self.output_dir, self.name + '.tmp'), osp.join(self.output_dir, self.name))
+        # in write order, so that the manifest fixes the row order of the file
+        self.manifest['files'].append({'name': self.name, 'num_rows': self.num_rows, 'chunks': self.chunks})
+        save_manifest(self.output_dir, self.manifest)
+        self.writer = None
+
+def load_rejects(output_dir):
+    path = osp.join(output_dir, rejects_name)
+    if not osp.exists(path):
+        return {}
+    rejects = {}
+    with open(path) as f:
+        for line in f:
+            reject = json.loads(line)
+            rejects[reject['index']] = reject
+    return rejects
+
+def preprocess(dataset, output_dir, tokenizer, phonemizer_factory=espeak_phonemizer, phonemizer_args=(),
+               num_workers=8, chunk_size=1000, task_size=16, rows_per_file=500000, timeout=60, max_memory=None):
+    """
+    Processes every chunk of `dataset` (with a `text` column) that the manifest of `output_dir`
+    does not list yet. `phonemizer_factory(*phonemizer_args)` creates the backend of every worker.
+    Chunks are dispatched as tasks of `task_size` documents, see Scheduler for `timeout` and
+    `max_memory`. Quarantined documents are appended to `rejects.jsonl` and skipped by reruns.
+    Returns the manifest.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir, chunk_size, len(dataset))
+    # files that were never committed are redone
+    for name in os.listdir(output_dir):
+        if name.endswith('.arrow.tmp'):
+            os.remove(osp.join(output_dir, name))
+    known_rejects = load_rejects(output_dir)
+
+    done = set(start for f in manifest['files'] for start in f['chunks'])
+    chunks = [start for start in range(0, len(dataset), chunk_size) if start not in done]
+    print('%d of %d chunks left, %d documents quarantined before' % (len(chunks), len(done) + len(chunks), len(known_rejects)))
+
+    # document indices of every chunk still waiting for results, and their rows so far
+    remaining = {}
+    rows = {}
+    def tasks():
+        for start in chunks:
+            indices = [idx for idx in range(start, min(start + chunk_size, len(dataset))) if idx not in known_rejects]
+            remaining[start] = set(indices)
+            rows[start] = []
+            if len(indices) == 0:
+                # only quarantined documents, written empty by the next flush
+                continue
+            for i in range(0, len(indices), task_size):
+                yield start, indices[i:i + task_size]
+
+    # the columns of the dataset with `text` replaced, fixed so that every chunk has the same types
+    schema = pa.schema([field for field in dataset.features.arrow_schema if field.name != 'text'] +
+                       [pa.field('input_ids', pa.list_(pa.int64())), pa.field('phonemes', pa.list_(pa.string()))])
+    writer = PartWriter(output_dir, manifest, schema, rows_per_file)
+    scheduler = Scheduler(dataset, tokenizer, phonemizer_factory, phonemizer_args, num_workers=num_workers, timeout=timeout, max_memory=max_memory)
+
+    def flush():
+        # write the chunks whose documents are all processed or quarantined, in document order
+        # whatever order their tasks finished in
+        finished = [start for start, left in remaining.items() if len(left) == 0]
+        for start in finished:
+            order = sorted((idx, part, i) for indices, part in rows[start] for i, idx in enumerate(indices))
+            writer.write(start, {field.name: [part[field.name][i] for _, part, i in order] for field in schema})
+            del remaining[start], rows[start]
+        return len(finished)
+
+    num_finished, num_reported = 0, 0
+    start_time = time.perf_counter()
+    with open(osp.join(output_dir, rejects_name), 'a') as rejects:
+        for event in scheduler.run(tasks()):
+            if event[0] == 'reject':
+                _, chunk, idx, reason = event
+                reject = {'index': idx, 'id': dataset[idx].get('id'), 'reason': reason}
+                rejects.write(json.dumps(reject) + '\n')
+                rejects.flush()
+                print('Quarantined document %d: %s' % (idx, reason))
+                remaining[chunk].discard(idx)
+            else:
+                _, chunk, indices, columns = event
+                rows[chunk].append((indices, columns))
+                remaining[chunk].difference_update(indices)
+
+            num_finished += flush()
+            if num_finished // 100 > num_reported:
+                num_reported = num_finished // 100
+                print('%d/%d chunks, %.1f chunks/s' % (num_finished, len(chunks), num_finished / (time.perf_counter() - start_time)))
+    flush()
+    writer.commit()
+    print(scheduler.report())
+    return manifest
+
+def load_processed(path):
+    """
+    Loads the output directory of `preprocess` as one memory-mapped `datasets.Dataset`, or a
+    directory written by `save_to_disk` (the notebook) if it has no manifest. The fingerprint of
+    the dataset is that of the manifest, caches keyed by it (e.g. dataloader.load_lengths) are
+    invalidated by a new preprocessing run.
+    """
+    from datasets import Dataset, concatenate_datasets, load_from_disk
+    if not osp.exists(osp.join(path, manifest_name)):
+        return load_from_disk(path)
+    with open(osp.join(path, manifest_name)) as f:
+        manifest = json.load(f)
+    dataset = concatenate_datasets([Dataset.from_file(osp.join(path, f['name'])) for f in manifest['files']])
+    # Dataset.from_file only hashes the file paths, which a rerun reuses
+    dataset._fingerprint = manifest_fingerprint(manifest)
+    return dataset
+
+if __name__ == '__main__':
+    import yaml
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--input', default=None, help='dataset saved with save_to_disk, defaults to the wikipedia 20220301.en dump')
+    parser.add_argument('--output', default=None, help='defaults to data_folder of the config')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=1000, help='documents per manifest entry, the unit of resumption')
+    parser.add_argument('--task_size', type=int, default=16, help='documents per task and phonemizer call')
+    parser.add_argument('--rows_per_file', type=int, default=500000)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds allowed per document')
+    parser.add_argument('--max_memory', type=int, default=None, help='MB a worker may allocate beyond its libraries')
+    parser.add_argument('--phoneme_cache', default=None, help='sqlite file of the word -> phonemes cache shared by the workers')
+    args = parser.parse_args()
+
+    from datasets import load_dataset, load_from_disk
+    from transformers import TransfoXLTokenizer
+
+    config = yaml.safe_load(open(args.config))
+    tokenizer = TransfoXLTokenizer.from_pretrained(config['dataset_params']['tokenizer'])
+    if args.input is not None:
+        dataset = load_from_disk(args.input)
+    else:
+        dataset = load_dataset("wikipedia", "20220301.en")['train']
+
+    output = args.output or config['data_folder']
+    manifest = preprocess(dataset, output, tokenizer,
+                          phonemizer_args=(args.phoneme_cache,),
+                          num_workers=args.num_workers,
+                          chunk_size=args.chunk_size,
+                          task_size=args.task_size,
+                          rows_per_file=args.rows_per_file,
+                          timeout=args.timeout,
+                          max_memory=args.max_memory * 2**20 if args.max_memory is not None else None)
+    print('%d documents in %d files at %s' % (sum(f['num_rows'] for f in manifest['files']), len(manifest['files']), output))
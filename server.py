@@ -0,0 +1,232 @@
+#coding: utf-8
+"""
+Local PL-BERT embedding server with dynamic micro-batching.
+
+Concurrent requests are queued for at most `max_wait_ms`, sorted by length and grouped
+into micro-batches of at most `max_batch_tokens` padded phonemes, each run as one forward pass.
+
+Endpoints (HTTP/1.1 over TCP or a Unix socket):
+  POST /encode   {"phonemes": "həlˈoʊ wˈɜːld"}  -> {"hidden_states": [[...], ...]}
+  GET  /metrics  latency percentiles and achieved batch sizes
+
+Usage:
+    python server.py --checkpoint Checkpoint/step_1000000.t7 --config Checkpoint/config.yml --port 8000
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+
+import numpy as np
+
+class Metrics(object):
+    """
+    Rolling window of request latencies and micro-batch sizes.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_tokens = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batch_sizes)
+        percentile = lambda q: float(np.percentile(latencies, q)) if len(latencies) > 0 else None
+        return {'requests': self.num_requests,
+                'batches': self.num_batches,
+                'latency_ms': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+                               'max': float(latencies.max()) if len(latencies) > 0 else None},
+                'batch_size': {'mean': float(batch_sizes.mean()) if len(batch_sizes) > 0 else None,
+                               'histogram': {int(k): int(v) for k, v in zip(*np.unique(batch_sizes, return_counts=True))}},
+                'padded_tokens_mean': float(np.mean(self.batch_tokens)) if len(self.batch_tokens) > 0 else None}
+
+class MicroBatcher(object):
+    """
+    Queues TextCleaner ids and runs them through `encoder.forward_batch` in length-grouped
+    micro-batches. The forward pass runs in a worker thread so the event loop keeps accepting.
+    """
+
+    def __init__(self, encoder, max_wait_ms=5, max_batch_tokens=8192, max_batch_size=64):
+        self.encoder = encoder
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.metrics = Metrics()
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def validate(self, ids):
+        if len(ids) > self.encoder.max_length:
+            raise ValueError('%d phonemes, more than the %d positions of the encoder' % (len(ids), self.encoder.max_length))
+        if len(ids) == 0:
+            raise ValueError('no phonemes to encode')
+
+    async def encode(self, ids):
+        self.validate(ids)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((ids, future, time.perf_counter()))
+        return await future
+
+    def split(self, pending):
+        # sort the pending requests by length and cut them into batches within the token budget
+        pending = sorted(pending, key=lambda r: len(r[0]))
+        batches = []
+        batch = []
+        for request in pending:
+            longest = max(len(request[0]), max((len(r[0]) for r in batch), default=0))
+            if len(batch) > 0 and (longest * (len(batch) + 1) > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(request)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(pending) < self.max_batch_size * 4:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # an unexpected error fails the pending requests instead of ending the task, which
+            # would leave every later request waiting forever
+            try:
+                await self.run_batches(pending)
+            except Exception as e:
+                self.fail(pending, e)
+
+    def fail(self, requests, error):
+        for _, future, _ in requests:
+            if not future.done():
+                future.set_exception(error)
+
+    async def run_batches(self, pending):
+        loop = asyncio.get_running_loop()
+        for batch in self.split(pending):
+            ids = [r[0] for r in batch]
+            try:
+                outputs = await loop.run_in_executor(None, self.encoder.forward_batch, ids)
+            except Exception as e:
+                self.fail(batch, e)
+                continue
+
+            now = time.perf_counter()
+            self.metrics.num_batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.batch_tokens.append(max(len(x) for x in ids) * len(batch))
+            for (_, future, start), hidden_states in zip(batch, outputs):
+                self.metrics.num_requests += 1
+                self.metrics.latencies.append(now - start)
+                if not future.done():
+                    future.set_result(hidden_states)
+
+REASONS = {200: b'OK', 400: b'Bad Request', 404: b'Not Found', 500: b'Internal Server Error'}
+
+class EncoderServer(object):
+    """
+    Minimal HTTP/1.1 front end of a MicroBatcher, with keep-alive connections.
+    """
+
+    def __init__(self, encoder, batcher):
+        self.encoder = encoder
+        self.batcher = batcher
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self.route(method, path, body)
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                             % (status, REASONS[status], len(payload)) + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics.report()
+        if method == 'POST' and path == '/encode':
+            try:
+                request = json.loads(body.decode('utf-8'))
+                if not isinstance(request, dict) or 'phonemes' not in request:
+                    raise ValueError('missing "phonemes"')
+                if not isinstance(request['phonemes'], str):
+                    raise ValueError('"phonemes" must be a string')
+                ids = self.encoder.text_cleaner(request['phonemes'])
+                self.batcher.validate(ids)
+            except (ValueError, TypeError) as e:
+                return 400, {'error': str(e)}
+            try:
+                hidden_states = await self.batcher.encode(ids)
+            except Exception as e:
+                return 500, {'error': '%s: %s' % (type(e).__name__, e)}
+            return 200, {'hidden_states': hidden_states.tolist()}
+        return 404, {'error': 'unknown endpoint %s %s' % (method, path)}
+
+async def serve(encoder, args):
+    batcher = MicroBatcher(encoder, max_wait_ms=args.max_wait_ms, max_batch_tokens=args.max_batch_tokens, max_batch_size=args.max_batch_size)
+    batcher.start()
+    server = EncoderServer(encoder, batcher)
+    if args.unix_socket is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        print('Serving on %s' % args.unix_socket)
+    else:
+        listener = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+        print('Serving on http://%s:%d' % (args.host, args.port))
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == '__main__':
+    import torch
+    from inference import PLBertEncoder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_wait_ms', type=float, default=5)
+    parser.add_argument('--max_batch_tokens', type=int, default=8192)
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    encoder = PLBertEncoder.from_checkpoint(args.checkpoint, args.config)
+    asyncio.run(serve(encoder, args))
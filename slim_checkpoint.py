@@ -0,0 +1,61 @@
+#coding: utf-8
+"""
+Converts a `step_*.t7` training checkpoint into an encoder-only safetensors file for inference.
+
+The training checkpoint holds the `module.`-prefixed MultiTaskModel weights (including the
+large word_predictor) and the AdamW state. The slim file only keeps the AlbertModel weights
+under their AlbertModel names, optionally in fp16, plus the training config, so that
+`PLBertEncoder.from_checkpoint("plbert.safetensors")` can memory-map it directly.
+
+Usage:
+    python slim_checkpoint.py Checkpoint/step_1000000.t7 plbert.safetensors --config Checkpoint/config.yml --fp16
+"""
+
+import os
+import json
+import argparse
+
+import torch
+from transformers import AlbertConfig, AlbertModel
+
+from inference import load_config, encoder_state_dict
+
+def slim_checkpoint(path, output_path, config, half=False):
+    """
+    Writes the encoder weights of checkpoint `path` to `output_path`, returns the number of tensors.
+    """
+    from safetensors.torch import save_file
+
+    config = load_config(config)
+    # mmap so that only the encoder weights are read from the checkpoint
+    checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    # keep the weights AlbertModel has now, older checkpoints also hold the position_ids buffer
+    keys = AlbertModel(AlbertConfig(**config['model_params'])).state_dict().keys()
+
+    state_dict = {}
+    for k, v in encoder_state_dict(checkpoint['net']).items():
+        if k not in keys:
+            continue
+        if half and v.is_floating_point():
+            v = v.half()
+        state_dict[k] = v.contiguous()
+
+    missing = set(keys) - set(state_dict)
+    if len(missing) > 0:
+        raise KeyError('checkpoint %s has no encoder weights for %s' % (path, ', '.join(sorted(missing))))
+
+    metadata = {'config': json.dumps(config), 'step': str(checkpoint.get('step', ''))}
+    save_file(state_dict, output_path, metadata=metadata)
+    return len(state_dict)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint')
+    parser.add_argument('output')
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--fp16', action='store_true', help='store the weights in half precision')
+    args = parser.parse_args()
+
+    num_tensors = slim_checkpoint(args.checkpoint, args.output, args.config, half=args.fp16)
+    print('Wrote %d tensors to %s (%.1f MB, checkpoint %.1f MB)' % (num_tensors, args.output,
+          os.path.getsize(args.output) / 2**20, os.path.getsize(args.checkpoint) / 2**20))
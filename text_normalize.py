@@ -1,11 +1,10 @@
-import pandas as pd
-
 from nltk.tokenize import TweetTokenizer
 from nltk.tokenize.treebank import TreebankWordDetokenizer
 import unicodedata
 
 import os, sys
 import re
+from collections import OrderedDict, Counter
 
 from converters.Plain      import Plain
 from converters.Punct      import Punct
@@ -75,6 +74,7 @@ def split_given_size(a, size):
     return np.split(a, np.arange(size,len(a),size))
 
 word_tokenize = TweetTokenizer().tokenize
+word_detokenize = TreebankWordDetokenizer().detokenize
 
 def normalize_split(text):
     words = word_tokenize(text)
@@ -121,53 +121,148 @@ def is_url(inputString):
 def has_month(inputString):
     return inputString.lower() in months or inputString == "May"
 
-def normalize_single(text, prev_text = "", next_text = ""):
+# everything normalize_single can change: urls, digits, "#" before a number and "$" (always stripped)
+convert_regex = re.compile(r'[0-9#$]|//|\.com|\.html')
+
+def needs_normalization(inputString):
+    if convert_regex.search(inputString) is not None:
+        return True
+    # non-ascii digits (e.g. "٣") are rare, fall back to the exact check
+    return not inputString.isascii() and has_numbers(inputString)
+
+def select_converter(text, prev_text = "", next_text = ""):
+    # label of the converter normalize_single uses for text, and whether its result depends on the
+    # neighbours (a month before or after the number), None if text only loses its "$"
     if is_url(text):
+        return 'ELECTRONIC', False
+    if not has_numbers(text):
+        return None, False
+    if has_month(prev_text) or has_month(next_text):
+        return 'DATE', True
+    if is_oridinal(text):
+        return 'ORDINAL', False
+    if is_time(text):
+        return 'TIME', False
+    if is_money(text):
+        return 'MONEY', False
+    if is_fraction(text):
+        return 'FRACTION', False
+    if is_decimal(text):
+        return 'DECIMAL', False
+    if is_cardinal(text):
+        return 'CARDINAL', False
+    if is_range(text):
+        return 'RANGE', False
+    return 'DATE', False
+
+def convert_single(label, text, prev_text = "", next_text = ""):
+    if label == 'ELECTRONIC':
         text = labels['ELECTRONIC'].convert(text).upper()
-    elif has_numbers(text):
-        if has_month(prev_text):
+    else:
+        if label == 'DATE' and has_month(prev_text):
             prev_text = labels['DATE'].get_month(prev_text.lower())
             text = labels['DATE'].convert(prev_text + " " + text).replace(prev_text, "").strip()
-        elif has_month(next_text):
+        elif label == 'DATE' and has_month(next_text):
             next_text = labels['DATE'].get_month(next_text.lower())
             text = labels['DATE'].convert(text + " " + next_text).replace(next_text, "").strip()
-        elif is_oridinal(text):
-            text = labels['ORDINAL'].convert(text)
-        elif is_time(text):
-            text = labels['TIME'].convert(text)
-        elif is_money(text):
-            text = labels['MONEY'].convert(text)
-        elif is_fraction(text):
-            text = labels['FRACTION'].convert(text)
-        elif is_decimal(text):
-            text = labels['DECIMAL'].convert(text)
-        elif is_cardinal(text):
-            text = labels['CARDINAL'].convert(text)
-        elif is_range(text):
-            text = labels['RANGE'].convert(text)
         else:
-            text = labels['DATE'].convert(text)
+            text = labels[label].convert(text)
         
         if has_numbers(text):
             text = labels['CARDINAL'].convert(text)
-    elif text == "#" and has_numbers(next_text):
-        text = "number"
 
     return text.replace("$", "")
 
-def normalize_text(text):
-    text = remove_accents(text).replace('–', ' to ').replace('-', ' - ').replace(":p", ": p").replace(":P", ": P").replace(":d", ": d").replace(":D", ": D")
-    words = word_tokenize(text)
+class ConversionCache(object):
+    """
+    Bounded LRU of converter results, with the hits and misses of every converter.
 
-    df = pd.DataFrame(words, columns=['before'])
+    Args:
+      max_size (int): number of results kept, 0 disables the cache.
+    """
 
-    df['after'] = df['before']
-    
-    df['previous'] = df.before.shift(1).fillna('') + "|" + df.before + "|" + df.before.shift(-1).fillna('')
-    
-    df['after'] = df['previous'].apply(lambda m: normalize_single(m.split('|')[1], m.split('|')[0], m.split('|')[2]))
-    
-    return TreebankWordDetokenizer().detokenize(df['after'].tolist()).replace("’ s", "'s").replace(" 's", "'s")
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def get(self, label, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses[label] += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits[label] += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.items[key] = value
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+    def stats(self):
+        converters = {}
+        for label in sorted(set(self.hits) | set(self.misses)):
+            lookups = self.hits[label] + self.misses[label]
+            converters[label] = {'hits': self.hits[label], 'misses': self.misses[label], 'hit_rate': self.hits[label] / lookups}
+        return {'size': len(self.items), 'max_size': self.max_size, 'converters': converters}
+
+# per process, every preprocessing worker fills its own
+conversion_cache = ConversionCache()
+
+def normalize_single(text, prev_text = "", next_text = ""):
+    label, uses_context = select_converter(text, prev_text, next_text)
+    if label is None:
+        if text == "#" and has_numbers(next_text):
+            return "number"
+        return text.replace("$", "")
+
+    # "2010" converts the same everywhere unless a month is next to it
+    key = (label, prev_text, text, next_text) if uses_context else (label, text)
+    normalized = conversion_cache.get(label, key)
+    if normalized is None:
+        normalized = convert_single(label, text, prev_text, next_text)
+        conversion_cache.put(key, normalized)
+    return normalized
+
+def preprocess_text(text):
+    return remove_accents(text).replace('–', ' to ').replace('-', ' - ').replace(":p", ": p").replace(":P", ": P").replace(":d", ": d").replace(":D", ": D")
+
+def normalize_words(words):
+    # slide a (prev, cur, next) window over the raw tokens, context is always the unnormalized neighbour
+    # plain tokens are passed through untouched, only flagged ones go to the converters
+    normalized = []
+    prev_text = ""
+    for i, text in enumerate(words):
+        if needs_normalization(text):
+            next_text = words[i + 1] if i + 1 < len(words) else ""
+            normalized.append(normalize_single(text, prev_text, next_text))
+        else:
+            normalized.append(text)
+        prev_text = text
+    return normalized
+
+def detokenize(words):
+    return word_detokenize(words).replace("’ s", "'s").replace(" 's", "'s")
+
+def normalize_text(text):
+    words = word_tokenize(preprocess_text(text))
+    return detokenize(normalize_words(words))
+
+def normalize_texts(texts):
+    """
+    Lazily normalize an iterable of documents, yielding one normalized string per document.
+    """
+    for text in texts:
+        yield normalize_text(text)
 
 if __name__ == '__main__' : 
     text = 'hello (23 Jan 2020, 12:10 AM)'
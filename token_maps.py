@@ -0,0 +1,132 @@
+#coding: utf-8
+"""
+Dense token maps: a NumPy array indexed by the tokenizer id that holds the id of the
+lower-cased word predicted by the model, or -1 for ids that never occur in the corpus.
+
+Saved as .npy and memory-mapped, so every DataLoader worker shares the same pages instead
+of unpickling its own dict of ~85k dicts.
+
+`build` counts the tokenizer ids of the processed dataset with `token_stats.scan_tokens` and
+writes the legacy pickle, the dense array and the occurrence count of every tokenizer id.
+
+Usage:
+    python token_maps.py build --config Configs/config.yml
+    python token_maps.py convert token_maps.pkl token_maps.npy
+"""
+
+import os
+import pickle
+import argparse
+
+import numpy as np
+
+from token_stats import scan_tokens
+
+def to_array(token_maps):
+    """
+    Converts the legacy `{tokenizer id: {'word': ..., 'token': ...}}` dict to the dense array.
+    """
+    lookup = np.full(max(token_maps) + 1, -1, dtype=np.int32)
+    ids = np.fromiter(token_maps.keys(), dtype=np.int64, count=len(token_maps))
+    lookup[ids] = np.fromiter((m['token'] for m in token_maps.values()), dtype=np.int32, count=len(token_maps))
+    return lookup
+
+def build_token_maps(counts, tokenizer, word_separator=3039):
+    """
+    Maps every tokenizer id that occurs (plus `word_separator`) to its lower-cased word, like the
+    preprocessing notebook, with a single decode and encode per id. The predicted words are
+    numbered in the order of their tokenizer ids.
+
+    Returns the legacy dict and the number of occurrences of every predicted word.
+    """
+    ids = np.nonzero(counts)[0].tolist()
+    if word_separator not in ids:
+        ids.append(word_separator)
+
+    words = {}
+    lower_ids = {}
+    for t in ids:
+        word = tokenizer.decode([t]).lower()
+        words[t] = word
+        lower_ids[t] = tokenizer.encode([word])[0]
+
+    tokens = {t: i for i, t in enumerate(sorted(set(lower_ids.values())))}
+    token_maps = {t: {'word': words[t], 'token': tokens[lower_ids[t]]} for t in ids}
+
+    word_counts = np.zeros(len(tokens), dtype=np.int64)
+    for t in ids:
+        word_counts[token_maps[t]['token']] += counts[t] if t < len(counts) else 0
+    return token_maps, word_counts
+
+def load_token_maps(path):
+    """
+    Returns the dense array, memory-mapped for .npy files and converted on the fly for legacy pickles.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with open(path, 'rb') as handle:
+        return to_array(pickle.load(handle))
+
+def lookup(token_maps, input_ids):
+    """
+    Maps tokenizer ids to token-map ids with one fancy-index, raising KeyError for ids the
+    token maps do not have (like the legacy dict).
+    """
+    input_ids = np.asarray(input_ids, dtype=np.int64)
+    # ids past the end (or negative) would raise IndexError or wrap around, check them first
+    in_range = (input_ids >= 0) & (input_ids < len(token_maps))
+    tokens = np.full(input_ids.shape, -1, dtype=np.int64)
+    tokens[in_range] = token_maps[input_ids[in_range]]
+    if (tokens < 0).any():
+        missing = input_ids[tokens < 0]
+        raise KeyError('tokenizer ids missing from the token maps: %s' % missing[:10].tolist())
+    return tokens
+
+def convert(args):
+    with open(args.pickle_path, 'rb') as handle:
+        token_maps = pickle.load(handle)
+    array = to_array(token_maps)
+    np.save(args.output_path, array)
+    print('Converted %d token maps to %s (%d entries, %d predicted words)' % (len(token_maps), args.output_path, len(array), array.max() + 1))
+
+def build(args):
+    import yaml
+    from transformers import TransfoXLTokenizer
+    from preprocess import load_processed
+
+    config = yaml.safe_load(open(args.config))
+    tokenizer = TransfoXLTokenizer.from_pretrained(config['dataset_params']['tokenizer'])
+    dataset = load_processed(args.data_folder or config['data_folder'])
+
+    counts = scan_tokens(dataset, num_workers=args.num_workers, minlength=len(tokenizer)).counts
+    token_maps, word_counts = build_token_maps(counts, tokenizer, config['dataset_params']['word_separator'])
+
+    output = args.output or config['dataset_params']['token_maps']
+    prefix = os.path.splitext(output)[0]
+    with open(prefix + '.pkl', 'wb') as handle:
+        pickle.dump(token_maps, handle)
+    np.save(prefix + '.npy', to_array(token_maps))
+    # occurrences per tokenizer id and per predicted word, to prune rare words from the vocabulary
+    np.save(prefix + '_counts.npy', counts)
+    np.save(prefix + '_word_counts.npy', word_counts)
+    print('%d tokens in the dataset, %d distinct ids mapped to %d predicted words, saved to %s.pkl/.npy' %
+          (counts.sum(), len(token_maps), len(word_counts), prefix))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('build', help='build the token maps from the processed dataset')
+    p.add_argument('--config', default="Configs/config.yml")
+    p.add_argument('--data_folder', default=None, help='processed dataset, defaults to data_folder of the config')
+    p.add_argument('--output', default=None, help='defaults to token_maps of the config, the .pkl and .npy are both written')
+    p.add_argument('--num_workers', type=int, default=os.cpu_count())
+    p.set_defaults(func=build)
+
+    p = subparsers.add_parser('convert', help='convert a legacy pickle to the dense array')
+    p.add_argument('pickle_path', help='legacy token_maps.pkl')
+    p.add_argument('output_path', help='dense .npy output')
+    p.set_defaults(func=convert)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,164 @@
+#coding: utf-8
+"""
+Token statistics of the processed dataset: occurrences and document frequency of every
+tokenizer id, and the histogram of the document lengths (in tokens).
+
+The `input_ids` column is scanned in row ranges by a pool of workers, each of which reads
+its range of the memory-mapped Arrow table with NumPy and returns only the unique ids with
+their counts, so no token of the corpus goes through a Python object.
+
+Usage:
+    python token_stats.py --config Configs/config.yml --output token_stats.npz --num_workers 32
+
+    stats = scan_tokens(dataset, num_workers=32)
+    stats.counts[token_id], stats.document_frequency[token_id], stats.length_histogram[length]
+"""
+
+import os
+import time
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+
+def grow(array, size):
+    if len(array) >= size:
+        return array
+    grown = np.zeros(size, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def read_rows(dataset, start, stop):
+    """
+    Flat tokenizer ids and per-document lengths of rows [start, stop).
+    """
+    if hasattr(dataset, 'with_format'):
+        column = dataset.with_format('arrow')[start:stop].column('input_ids')
+        ids = [np.asarray(chunk.flatten().to_numpy(zero_copy_only=False), dtype=np.int64) for chunk in column.chunks]
+        lengths = [np.asarray(chunk.value_lengths().fill_null(0).to_numpy(zero_copy_only=False), dtype=np.int64) for chunk in column.chunks]
+    else:
+        samples = [dataset[i]['input_ids'] for i in range(start, stop)]
+        ids = [np.asarray(sample, dtype=np.int64) for sample in samples]
+        lengths = [np.array([len(sample) for sample in samples], dtype=np.int64)]
+    empty = np.zeros(0, dtype=np.int64)
+    return np.concatenate(ids or [empty]), np.concatenate(lengths or [empty])
+
+def scan_rows(dataset, start, stop):
+    """
+    Statistics of rows [start, stop) as sparse (unique id, count) arrays.
+    """
+    ids, lengths = read_rows(dataset, start, stop)
+    counts = np.bincount(ids)
+    token_ids = np.flatnonzero(counts)
+
+    # each (document, id) pair once for the document frequency, sorted rather than np.unique
+    # which hashes (much slower for tens of millions of ids)
+    width = len(counts)
+    documents = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    pairs = np.sort(documents * width + ids)
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    document_counts = np.bincount(pairs[first] % width, minlength=width)
+
+    return {'num_documents': len(lengths),
+            'token_ids': token_ids, 'counts': counts[token_ids], 'document_counts': document_counts[token_ids],
+            'length_histogram': np.bincount(lengths)}
+
+class TokenStats(object):
+    """
+    Args:
+      minlength (int): minimum length of the per-id arrays, usually the tokenizer size.
+    """
+
+    def __init__(self, minlength=0):
+        self.num_documents = 0
+        self.counts = np.zeros(minlength, dtype=np.int64)
+        self.document_frequency = np.zeros(minlength, dtype=np.int64)
+        self.length_histogram = np.zeros(0, dtype=np.int64)
+
+    def update(self, partial):
+        """
+        Adds the result of `scan_rows`.
+        """
+        self.num_documents += partial['num_documents']
+        if len(partial['token_ids']):
+            size = int(partial['token_ids'][-1]) + 1
+            self.counts = grow(self.counts, size)
+            self.document_frequency = grow(self.document_frequency, size)
+            # the ids are unique, so plain fancy-index addition is safe
+            self.counts[partial['token_ids']] += partial['counts']
+            self.document_frequency[partial['token_ids']] += partial['document_counts']
+        self.length_histogram = grow(self.length_histogram, len(partial['length_histogram']))
+        self.length_histogram[:len(partial['length_histogram'])] += partial['length_histogram']
+        return self
+
+    @property
+    def num_tokens(self):
+        return int(self.counts.sum())
+
+    def save(self, path):
+        np.savez(path, num_documents=self.num_documents, counts=self.counts,
+                 document_frequency=self.document_frequency, length_histogram=self.length_histogram)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls()
+        stats.num_documents = int(data['num_documents'])
+        stats.counts = data['counts']
+        stats.document_frequency = data['document_frequency']
+        stats.length_histogram = data['length_histogram']
+        return stats
+
+_dataset = None
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+def _scan_range(rows):
+    return scan_rows(_dataset, *rows)
+
+def scan_tokens(dataset, num_workers=os.cpu_count(), chunk_size=10000, minlength=0):
+    """
+    Scans the `input_ids` of `dataset` (a `datasets.Dataset`, or any sequence of rows) in
+    ranges of `chunk_size` rows, in parallel if `num_workers` > 1. Returns a TokenStats.
+    """
+    stats = TokenStats(minlength)
+    ranges = [(start, min(start + chunk_size, len(dataset))) for start in range(0, len(dataset), chunk_size)]
+    if num_workers is None or num_workers <= 1 or len(ranges) <= 1:
+        for rows in ranges:
+            stats.update(scan_rows(dataset, *rows))
+        return stats
+
+    # memory-mapped datasets are pickled as their file paths, so every worker maps the same pages
+    with mp.get_context('spawn').Pool(min(num_workers, len(ranges)), initializer=_init_worker, initargs=(dataset,)) as pool:
+        for partial in pool.imap_unordered(_scan_range, ranges):
+            stats.update(partial)
+    return stats
+
+if __name__ == '__main__':
+    import yaml
+    from preprocess import load_processed
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="Configs/config.yml")
+    parser.add_argument('--data_folder', default=None, help='processed dataset, defaults to data_folder of the config')
+    parser.add_argument('--output', default='token_stats.npz')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=10000, help='rows per task')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    dataset = load_processed(args.data_folder or config['data_folder'])
+
+    start = time.perf_counter()
+    stats = scan_tokens(dataset, num_workers=args.num_workers, chunk_size=args.chunk_size)
+    elapsed = time.perf_counter() - start
+    stats.save(args.output)
+
+    lengths = np.arange(len(stats.length_histogram))
+    print('%d documents, %d tokens, %d distinct ids in %.1fs' % (stats.num_documents, stats.num_tokens, (stats.counts > 0).sum(), elapsed))
+    if stats.num_documents:
+        print('document length: mean %.1f, max %d' % ((lengths * stats.length_histogram).sum() / stats.num_documents, lengths[-1]))
+    print('Token statistics saved to %s' % args.output)
@@ -1,13 +1,15 @@
-import glob
 import torch
 
+from checkpoint import CheckpointIndex
+
 def scan_checkpoint(cp_dir):
-    pattern = os.path.join(cp_dir)
-    cp_list = glob.glob(pattern)
-    print(cp_list)
-    if len(cp_list) == 0:
+    """
+    Path of the newest `step_*.t7` checkpoint of `cp_dir` (by step, from its manifest), None if there is none.
+    """
+    latest = CheckpointIndex(cp_dir).latest()
+    if latest is None:
         return None
-    return sorted(cp_list)[-1]
+    return latest[1]
 
 def length_to_mask(lengths):
     mask = torch.arange(lengths.max()).unsqueeze(0).expand(lengths.shape[0], -1).type_as(lengths)